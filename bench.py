@@ -0,0 +1,390 @@
+"""
+Benchmark + regression harness for the `mcenv` launchers
+
+Puts stub `docker`/`podman`/`singularity`/`shifter` (and `python3`, for `CLI.sh`) binaries
+on the `PATH` that just record the arguments they were called with, so that on a plain Linux box we can
+
+    * check the commands `env.sh` and `CLI.sh` build against the expected mounts/args
+    * time `env.sh` launcher overhead, `CLI.sh` dispatch and `CLI.py` startup separately
+
+Run as
+
+    python bench.py [--iterations=N] [--stages=launch,dispatch,startup] [--save=FILE] [--baseline=FILE]
+
+and it exits non-zero if a command came out wrong or a stage got slower than the baseline allows.
+"""
+
+import sys, os, json, argparse, subprocess, tempfile, shutil, shlex, statistics
+
+source_dir = os.path.dirname(os.path.abspath(__file__))
+env_file = os.path.join(source_dir, "env.sh")
+cli_sh_file = os.path.join(source_dir, "CLI.sh")
+cli_py_file = os.path.join(source_dir, "CLI.py")
+
+stub_runners = ['docker', 'podman', 'singularity', 'shifter', 'python3']
+# records one call per line as `name<US>arg1<US>arg2...` using only builtins so
+# the stub costs as little as possible next to what we're measuring
+stub_template = """#!/bin/bash
+{ printf '%s' "${0##*/}"; for a in "$@"; do printf '\\x1f%s' "$a"; done; printf '\\n'; } >> "${MCENV_BENCH_LOG:-/dev/null}"
+"""
+
+class LauncherCase:
+    """
+    A single call into the launchers along with the
+    commands we expect the stubs to receive
+    """
+    def __init__(self, name, call, expected, dirs=(), files=(), env=None, stdout=None):
+        """
+        :param name: name for reporting
+        :type name: str
+        :param call: shell snippet to run, `env.sh` is already sourced
+        :type call: str
+        :param expected: expected calls as argv lists, `{root}` is replaced by the working dir
+        :type expected: list
+        :param dirs: directories to create in the working dir
+        :type dirs: Iterable[str]
+        :param files: files to create in the working dir
+        :type files: Iterable[str]
+        :param env: extra environment variables
+        :type env: dict
+        :param stdout: expected stdout, if checked
+        :type stdout: str | None
+        """
+        self.name = name
+        self.call = call
+        self.expected = expected
+        self.dirs = dirs
+        self.files = files
+        self.env = {} if env is None else env
+        self.stdout = stdout
+
+    def format(self, obj, root):
+        if isinstance(obj, str):
+            return obj.format(root=root)
+        else:
+            return [self.format(o, root) for o in obj]
+
+def mount(src, target):
+    return ["--mount", "type=bind,source={},target={}".format(src, target)]
+
+launcher_cases = [
+    LauncherCase(
+        "docker_plain",
+        "mcenv_docker --script run.py a b",
+        [["docker", "run", "--rm", "-it", "mcenv", "--script", "run.py", "a", "b"]]
+    ),
+    LauncherCase(
+        "docker_mounts",
+        "mcenv_docker --script run.py",
+        [["docker", "run", "--rm",
+          *mount("{root}/packages", "/home/packages"),
+          *mount("{root}/scripts", "/home/scripts"),
+          *mount("/opt/McEnv", "/home/McEnv"),
+          "-it", "mcenv", "--script", "run.py"]],
+        dirs=["packages", "scripts"],
+        env={"MCENV_SOURCE_PATH": "/opt/McEnv"}
+    ),
+    LauncherCase(
+        "docker_volume",
+        "mcenv_docker -V /data:/home/data --script run.py",
+        [["docker", "run", "--rm",
+          *mount("/data", "/home/data"),
+          *mount("{root}/packages", "/home/packages"),
+          "-it", "mcenv", "--script", "run.py"]],
+        dirs=["packages"]
+    ),
+    LauncherCase(
+        "docker_runner",
+        "mcenv_docker --help",
+        [["podman", "run", "--rm", "-it", "custom", "--help"]],
+        env={"MCENV_CONTAINER_RUNNER": "podman", "MCENV_IMAGE": "custom"}
+    ),
+    LauncherCase(
+        "docker_echo",
+        "mcenv_docker -e --help",
+        [],
+        dirs=["scripts"],
+        stdout="docker run --rm --mount type=bind,source={root}/scripts,target=/home/scripts -it mcenv\n"
+    ),
+    LauncherCase(
+        "singularity_mounts",
+        "mcenv_singularity -G --script run.py",
+        [["singularity", "run", "--nv", "--bind", "{root}/packages:/home/packages,{root}/scripts:/home/scripts",
+          "mcenv.sif", "--script", "run.py"]],
+        dirs=["packages", "scripts"]
+    ),
+    LauncherCase(
+        "singularity_image",
+        "mcenv_singularity files hash x",
+        [["singularity", "run", "other.sif", "files", "hash", "x"]],
+        env={"MCENV_IMAGE": "other.sif"}
+    ),
+    LauncherCase(
+        "shifter_mounts",
+        "mcenv_shifter --script run.py",
+        [["shifter", "--image=mccoygroup/mcenv:latest",
+          "--volume={root}/packages:/home/packages", "--volume=/opt/McEnv:/home/McEnv",
+          "/bin/bash", "/home/McEnv/CLI.sh", "--script", "run.py"]],
+        dirs=["packages"],
+        env={"MCENV_SHIFTER_IMAGE": "mccoygroup/mcenv:latest", "MCENV_SOURCE_PATH": "/opt/McEnv"}
+    ),
+    LauncherCase(
+        "mcenv_sif",
+        "mcenv --script run.py",
+        [["singularity", "run", "mcenv.sif", "--script", "run.py"]],
+        files=["mcenv.sif"]
+    ),
+    LauncherCase(
+        "mcenv_default",
+        "mcenv --script run.py",
+        [["docker", "run", "--rm", "-it", "mcenv", "--script", "run.py"]]
+    )
+]
+if os.path.exists("/usr/bin/shifter"):
+    # `mcenv` always prefers shifter when it's installed so the auto-detection cases don't apply
+    launcher_cases = [c for c in launcher_cases if not c.name.startswith("mcenv_")]
+
+dispatch_cases = [
+    LauncherCase(
+        "cli_python",
+        'bash "$MCENV_CLI_SH" --script run.py a',
+        [["python3", "-u", "/home/McEnv/CLI.py", "--script", "run.py", "a"]]
+    ),
+    LauncherCase(
+        "cli_exec",
+        'bash "$MCENV_CLI_SH" --exec docker ps -a',
+        [["docker", "ps", "-a"]]
+    )
+]
+
+class LauncherBench:
+    """
+    Sets up the stub runners and a scratch directory and
+    provides the correctness checks and timing loops
+    """
+    def __init__(self, iterations=200, root=None):
+        self.iterations = iterations
+        self.root = tempfile.mkdtemp(prefix="mcenv_bench_") if root is None else root
+        self.bin_dir = os.path.join(self.root, "bin")
+        self.log_file = os.path.join(self.root, "calls.log")
+        os.makedirs(self.bin_dir, exist_ok=True)
+        for name in stub_runners:
+            stub = os.path.join(self.bin_dir, name)
+            with open(stub, 'w') as f:
+                f.write(stub_template)
+            os.chmod(stub, 0o755)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def get_env(self, extra=None, log_file=None):
+        env = {
+            "PATH": self.bin_dir + os.pathsep + "/usr/bin:/bin",
+            "HOME": os.environ.get("HOME", self.root),
+            "LC_ALL": "C",
+            "MCENV_BENCH_LOG": self.log_file if log_file is None else log_file,
+            "MCENV_ENV_SH": env_file,
+            "MCENV_CLI_SH": cli_sh_file
+        }
+        if extra is not None:
+            env.update(extra)
+        return env
+
+    def prep_case(self, case):
+        work_dir = os.path.join(self.root, case.name)
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        for d in case.dirs:
+            os.makedirs(os.path.join(work_dir, d))
+        for f in case.files:
+            open(os.path.join(work_dir, f), 'w').close()
+        return work_dir
+
+    def read_calls(self):
+        if not os.path.exists(self.log_file):
+            return []
+        with open(self.log_file) as f:
+            return [line.rstrip("\n").split("\x1f") for line in f if line.strip()]
+
+    def check_case(self, case):
+        """
+        Runs `case` once and compares what the stubs saw against what was expected
+
+        :param case:
+        :type case: LauncherCase
+        :return: error messages, empty if everything matched
+        :rtype: list[str]
+        """
+        work_dir = self.prep_case(case)
+        if os.path.exists(self.log_file):
+            os.remove(self.log_file)
+        script = 'source "$MCENV_ENV_SH"\n' + case.call
+        res = subprocess.run(["bash", "-c", script], cwd=work_dir, env=self.get_env(case.env),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        errors = []
+        calls = self.read_calls()
+        expected = case.format(case.expected, work_dir)
+        if calls != expected:
+            errors.append("{}: expected calls\n    {}\n  got\n    {}".format(
+                case.name,
+                "\n    ".join(shlex.join(c) for c in expected) or "<none>",
+                "\n    ".join(shlex.join(c) for c in calls) or "<none>"
+            ))
+        if case.stdout is not None:
+            stdout = case.format(case.stdout, work_dir)
+            if res.stdout != stdout:
+                errors.append("{}: expected stdout {!r} got {!r}".format(case.name, stdout, res.stdout))
+        return errors
+
+    def time_loop(self, command, setup="", cwd=None, env=None):
+        """
+        Times `command` in a loop inside a single shell so that we only measure the
+        command itself and not process setup on our side
+
+        :param command: shell snippet to time
+        :type command: str
+        :param setup: shell snippet run once before timing
+        :type setup: str
+        :return: per-call times in ms
+        :rtype: list[float]
+        """
+        times_file = os.path.join(self.root, "times.txt")
+        script = "\n".join([
+            setup,
+            'exec 3>"{}"'.format(times_file),
+            '{} >/dev/null 2>&1'.format(command), # warm-up
+            'for ((i=0; i<{}; i++)); do'.format(self.iterations),
+            '  printf "%s\\n" "$EPOCHREALTIME" >&3',
+            '  {} >/dev/null 2>&1'.format(command),
+            'done',
+            'printf "%s\\n" "$EPOCHREALTIME" >&3'
+        ])
+        subprocess.run(["bash", "-c", script], cwd=self.root if cwd is None else cwd,
+                       env=self.get_env(env, log_file=os.devnull), check=True)
+        with open(times_file) as f:
+            stamps = [float(x) for x in f.read().split()]
+        if len(stamps) != self.iterations + 1:
+            raise ValueError("couldn't read timings (needs bash >= 5 for $EPOCHREALTIME)")
+        return [1000 * (b - a) for a, b in zip(stamps, stamps[1:])]
+
+    def time_case(self, case):
+        work_dir = self.prep_case(case)
+        return self.time_loop(case.call, setup='source "$MCENV_ENV_SH"', cwd=work_dir, env=case.env)
+
+    def stages(self):
+        """
+        Returns the timed stages as `(stage, name, thunk)` with the
+        `baseline` entries giving the floor each stage sits on
+        """
+        py = shlex.quote(sys.executable)
+        script_dir = os.path.join(self.root, "startup")
+        os.makedirs(script_dir, exist_ok=True)
+        with open(os.path.join(script_dir, "noop.py"), 'w') as f:
+            f.write("")
+        startup = lambda cmd: (lambda: self.time_loop(cmd, cwd=script_dir))
+        return [
+            ("baseline", "stub_exec", lambda: self.time_loop("docker run")),
+            ("baseline", "bash_startup", lambda: self.time_loop("bash /dev/null")),
+            ("baseline", "python_startup", startup(py + " -u -c pass")),
+            *[("launch", c.name, (lambda c=c: self.time_case(c))) for c in launcher_cases],
+            *[("dispatch", c.name, (lambda c=c: self.time_case(c))) for c in dispatch_cases],
+            ("startup", "cli_script", startup("{} -u {} --script noop.py".format(py, shlex.quote(cli_py_file)))),
+            ("startup", "cli_command", startup("{} -u {} files hash noop.py".format(py, shlex.quote(cli_py_file))))
+        ]
+
+    def check(self):
+        errors = []
+        for case in launcher_cases + dispatch_cases:
+            errors.extend(self.check_case(case))
+        return errors
+
+    def run(self, stages=None):
+        """
+        Runs the timing loops
+
+        :param stages: which stages to time, baselines are always included
+        :type stages: Iterable[str] | None
+        :return: timing summaries keyed by `stage/name`
+        :rtype: dict
+        """
+        results = {}
+        for stage, name, thunk in self.stages():
+            if stage != "baseline" and stages is not None and stage not in stages:
+                continue
+            times = sorted(thunk())
+            results[stage + "/" + name] = {
+                "median": statistics.median(times),
+                "mean": statistics.fmean(times),
+                "min": times[0],
+                "p90": times[int(.9 * (len(times) - 1))]
+            }
+        return results
+
+def compare_to_baseline(results, baseline, tolerance=.25, slack=1.):
+    """
+    Flags any stage whose median grew by more than `tolerance` (relative)
+    plus `slack` ms, the latter so sub-ms noise can't trip it
+
+    :return: error messages
+    :rtype: list[str]
+    """
+    errors = []
+    for key, stats in results.items():
+        if key.startswith("baseline/") or key not in baseline:
+            continue
+        limit = baseline[key]["median"] * (1 + tolerance) + slack
+        if stats["median"] > limit:
+            errors.append("{}: median {:.2f}ms exceeds {:.2f}ms (baseline {:.2f}ms)".format(
+                key, stats["median"], limit, baseline[key]["median"]
+            ))
+    return errors
+
+def format_results(results):
+    floors = {
+        "launch": results.get("baseline/stub_exec"),
+        "dispatch": results.get("baseline/bash_startup"),
+        "startup": results.get("baseline/python_startup")
+    }
+    lines = ["{:<32} {:>9} {:>9} {:>9} {:>9} {:>10}".format("stage", "median", "mean", "min", "p90", "overhead")]
+    for key, stats in results.items():
+        floor = floors.get(key.split("/")[0])
+        overhead = "" if floor is None else "{:.2f}".format(stats["median"] - floor["median"])
+        lines.append("{:<32} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10}".format(
+            key, stats["median"], stats["mean"], stats["min"], stats["p90"], overhead
+        ))
+    lines.append("(times in ms per call, overhead is over the matching baseline)")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark and check the mcenv launchers")
+    parser.add_argument('--iterations', type=int, default=200, dest='iterations')
+    parser.add_argument('--stages', type=str, default='launch,dispatch,startup', dest='stages')
+    parser.add_argument('--check-only', default=False, action='store_const', const=True, dest='check_only')
+    parser.add_argument('--save', type=str, default='', dest='save')
+    parser.add_argument('--baseline', type=str, default='', dest='baseline')
+    parser.add_argument('--tolerance', type=float, default=.25, dest='tolerance')
+    parser.add_argument('--slack', type=float, default=1., dest='slack')
+    opts = parser.parse_args()
+
+    bench = LauncherBench(iterations=opts.iterations)
+    try:
+        errors = bench.check()
+        for e in errors:
+            print("FAIL " + e)
+        if not opts.check_only:
+            results = bench.run(stages=opts.stages.split(","))
+            print(format_results(results))
+            if opts.save != '':
+                with open(opts.save, 'w') as f:
+                    json.dump(results, f, indent=2)
+            if opts.baseline != '':
+                with open(opts.baseline) as f:
+                    baseline = json.load(f)
+                regressions = compare_to_baseline(results, baseline, tolerance=opts.tolerance, slack=opts.slack)
+                for e in regressions:
+                    print("SLOW " + e)
+                errors.extend(regressions)
+    finally:
+        bench.cleanup()
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,109 @@
+"""
+Per-user caches for McEnv, including the bytecode cache for the read-only trees.
+This is kept apart from `mcenv_cli` so that the cache can be installed
+before the bulk of the CLI gets imported
+"""
+
+import sys, os, hashlib, tempfile
+import importlib.machinery # bytecode cache
+
+def get_cache_dir(*subdirs):
+    """
+    Returns (and creates) a per-user McEnv cache directory.
+    Uses `MCENV_CACHE_PATH` if set, otherwise the usual XDG location,
+    falling back to the temp dir if home isn't writable
+    """
+    root = os.environ.get("MCENV_CACHE_PATH", "")
+    if root == "":
+        root = os.environ.get("XDG_CACHE_HOME", "")
+        if root == "":
+            root = os.path.join(os.path.expanduser("~"), ".cache")
+        root = os.path.join(root, "mcenv")
+    path = os.path.join(root, *subdirs)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        path = os.path.join(tempfile.gettempdir(), "mcenv-{}".format(os.getuid()), *subdirs)
+        os.makedirs(path, exist_ok=True)
+    return path
+
+def get_image_version():
+    """
+    Returns a tag identifying the current image so that caches
+    don't get shared across image updates.
+    Uses `MCENV_IMAGE_VERSION` if set, otherwise the time the McEnv source was added
+    """
+    version = os.environ.get("MCENV_IMAGE_VERSION", "")
+    if version == "":
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        version = str(os.stat(src_dir).st_mtime)
+    version = hashlib.sha1((version + sys.version).encode()).hexdigest()[:12]
+    return "{}-{}".format(sys.implementation.cache_tag, version)
+
+class CachedBytecodeLoader(importlib.machinery.SourceFileLoader):
+    """
+    Source loader that reads and writes bytecode under `cache_dir` (laid out the same way
+    `sys.pycache_prefix` would) instead of next to the source, so only the trees it's installed
+    for get redirected and everything else keeps using its own `__pycache__`
+    """
+    cache_dir = None
+    def redirect(self, path):
+        head, tail = os.path.split(path)
+        if self.cache_dir is None or os.path.basename(head) != "__pycache__":
+            return path
+        src_dir = os.path.abspath(os.path.dirname(head))
+        return os.path.join(self.cache_dir, src_dir.lstrip(os.sep), tail)
+    def get_data(self, path):
+        if path.endswith(tuple(importlib.machinery.BYTECODE_SUFFIXES)):
+            path = self.redirect(path)
+        return super().get_data(path)
+    def set_data(self, path, data, *, _mode=0o666):
+        if path.endswith(tuple(importlib.machinery.BYTECODE_SUFFIXES)):
+            path = self.redirect(path)
+        return super().set_data(path, data, _mode=_mode)
+
+def install_bytecode_cache(cache_dir, roots):
+    """
+    Adds a path hook so that modules imported from under `roots`
+    keep their bytecode in `cache_dir`
+    """
+    from importlib.machinery import FileFinder, ExtensionFileLoader, SourcelessFileLoader
+
+    loader = type("CachedBytecodeLoader", (CachedBytecodeLoader,), {"cache_dir": cache_dir})
+    roots = [os.path.abspath(r) for r in roots]
+    loader_details = [
+        (ExtensionFileLoader, importlib.machinery.EXTENSION_SUFFIXES),
+        (loader, importlib.machinery.SOURCE_SUFFIXES),
+        (SourcelessFileLoader, importlib.machinery.BYTECODE_SUFFIXES)
+    ]
+    def path_hook(path):
+        full = os.path.abspath(path if path != "" else os.getcwd())
+        if not any(full == r or full.startswith(r + os.sep) for r in roots):
+            raise ImportError("not a cached path")
+        return FileFinder(path, *loader_details)
+    sys.path_hooks.insert(0, path_hook)
+    # finders that were already created for these paths need to be rebuilt
+    for path in list(sys.path_importer_cache):
+        full = os.path.abspath(path if path != "" else os.getcwd())
+        if any(full == r or full.startswith(r + os.sep) for r in roots):
+            del sys.path_importer_cache[path]
+    return path_hook
+
+def configure_pycache(roots):
+    """
+    Points the bytecode cache for `roots` at a per-user, per-image directory,
+    since those trees are often read-only or on shared storage and would otherwise
+    get recompiled on every run.
+    An explicit `PYTHONPYCACHEPREFIX` takes precedence
+
+    :return: the cache directory, if there is one
+    :rtype: str | None
+    """
+    if os.environ.get("PYTHONPYCACHEPREFIX", "") != "":
+        return sys.pycache_prefix
+    try:
+        prefix = get_cache_dir("pycache", get_image_version())
+    except OSError:
+        return None
+    install_bytecode_cache(prefix, roots)
+    return prefix
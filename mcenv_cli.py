@@ -0,0 +1,1314 @@
+"""
+The implementation of the McEnv command-line interface, which `CLI.py` runs.
+It lives in its own module so that it can be loaded from the bytecode cache
+"""
+
+import sys, os, argparse, runpy, importlib, hashlib, shutil, json, threading, time
+from mcenv_cache import get_cache_dir, get_image_version, configure_pycache
+
+def set_script_module(name, spec, var_dict):
+    """
+    Makes sure the script module is registered
+    to break pickling issues if a __name__ == '__main__' block
+    equivalent is called in the script
+    """
+    # multiprocessing fucks us over in a script environment
+    # so we gotta do a bit of extra shit
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    for k,v in var_dict.items():
+        setattr(mod, k, v)
+
+def run_map_task(task_spec):
+    """
+    Runs a single task from `--map` mode in a pool worker.
+    The script module gets looked up by name, which is why it needs
+    to have been registered through `set_script_module`
+    """
+    mod_name, entry, index, task = task_spec
+    mod = sys.modules.get(mod_name, None)
+    if mod is None:
+        mod = importlib.import_module(mod_name)
+    fn = getattr(mod, entry)
+    try:
+        if isinstance(task, dict):
+            res = fn(**task)
+        elif isinstance(task, list):
+            res = fn(*task)
+        else:
+            res = fn(task)
+    except Exception as e:
+        return {"task": index, "error": "{}: {}".format(type(e).__name__, e)}
+    try:
+        json.dumps(res)
+    except (TypeError, ValueError):
+        res = str(res)
+    return {"task": index, "result": res}
+
+def get_core_count():
+    """
+    Returns the number of cores we're actually allowed to use,
+    preferring what SLURM gave us over what the node has
+    """
+    cpus = os.environ.get("SLURM_CPUS_PER_TASK", "")
+    if cpus.isdigit() and int(cpus) > 0:
+        return int(cpus)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def iter_files(root):
+    """
+    Walks `root` and yields the paths of all the files in it
+    relative to `root` (or just the file name if `root` is a file)
+    """
+    if os.path.isfile(root):
+        yield os.path.basename(root)
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        for f in filenames:
+            yield f if rel == "." else os.path.join(rel, f)
+
+def _kernel_copy(src_fd, dest_fd, size, chunk_size=2**30):
+    """
+    Tries to copy `size` bytes in-kernel, first with `copy_file_range`
+    and then with `sendfile`, returning how far we got
+    """
+    copied = 0
+    for copier in ("copy_file_range", "sendfile"):
+        if not hasattr(os, copier):
+            continue
+        try:
+            while copied < size:
+                count = min(chunk_size, size - copied)
+                if copier == "copy_file_range":
+                    n = os.copy_file_range(src_fd, dest_fd, count, copied, copied)
+                else:
+                    os.lseek(dest_fd, copied, os.SEEK_SET)
+                    n = os.sendfile(dest_fd, src_fd, copied, count)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            # e.g. cross-device or unsupported FS, so try the next option
+            continue
+        else:
+            break
+    return copied
+
+def copy_file(src, dest, buffer_size=2**24):
+    """
+    Copies `src` to `dest` (preserving metadata) with an in-kernel transfer
+    where possible and a large buffered copy otherwise
+
+    :param src:
+    :type src: str
+    :param dest:
+    :type dest: str
+    :return: number of bytes copied
+    :rtype: int
+    """
+    dest_dir = os.path.dirname(dest)
+    if dest_dir != "":
+        os.makedirs(dest_dir, exist_ok=True)
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        size = os.fstat(s.fileno()).st_size
+        copied = _kernel_copy(s.fileno(), d.fileno(), size)
+        if copied < size:
+            s.seek(copied)
+            d.seek(copied)
+            shutil.copyfileobj(s, d, buffer_size)
+    shutil.copystat(src, dest)
+    return size
+
+def hash_file(path, algorithm='sha256', buffer_size=2**20):
+    """
+    Hashes the contents of `path` in `buffer_size` blocks
+
+    :param path:
+    :type path: str
+    :param algorithm:
+    :type algorithm: str
+    :return:
+    :rtype: str
+    """
+    hasher = hashlib.new(algorithm)
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        n = f.readinto(buf)
+        while n > 0:
+            hasher.update(view[:n])
+            n = f.readinto(buf)
+    return hasher.hexdigest()
+
+def get_thread_count(threads=0):
+    """
+    Picks a thread count for I/O bound work
+    """
+    if threads <= 0:
+        threads = min(32, get_core_count() + 4)
+    return threads
+
+def hash_tree(root, threads=0, algorithm='sha256'):
+    """
+    Hashes all of the files in `root` in parallel
+
+    :return: map from relative path to digest
+    :rtype: dict
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    files = sorted(iter_files(root))
+    if os.path.isfile(root):
+        paths = [root]
+    else:
+        paths = [os.path.join(root, f) for f in files]
+    with ThreadPoolExecutor(get_thread_count(threads)) as pool:
+        digests = pool.map(lambda p: hash_file(p, algorithm=algorithm), paths)
+        return dict(zip(files, digests))
+
+def copy_tree(src, dest, files=None, threads=0):
+    """
+    Copies the files in `src` (or just `files` if passed) into `dest` in parallel,
+    a single file is copied into `dest` if it's an existing directory and to `dest` otherwise
+
+    :return: total number of bytes copied
+    :rtype: int
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if os.path.isfile(src):
+        if not os.path.isdir(dest):
+            # plain file-to-file copy
+            return copy_file(src, dest)
+        src, files = os.path.dirname(src), [os.path.basename(src)]
+    elif files is None:
+        files = list(iter_files(src))
+    with ThreadPoolExecutor(get_thread_count(threads)) as pool:
+        sizes = pool.map(lambda f: copy_file(os.path.join(src, f), os.path.join(dest, f)), files)
+        return sum(sizes)
+
+manifest_file = ".mcenv_manifest.json"
+def sync_tree(src, dest, threads=0, checksum=False, delete=False):
+    """
+    Incrementally syncs `src` into `dest`, using a manifest stored in `dest`
+    to skip files whose size and mtime (or hash if `checksum`) haven't changed
+    since the last sync
+
+    :return: lists of the copied, skipped, and deleted files
+    :rtype: dict
+    """
+    manifest_path = os.path.join(dest, manifest_file)
+    try:
+        with open(manifest_path) as m:
+            manifest = json.load(m)
+    except (OSError, ValueError):
+        manifest = {}
+
+    files = sorted(f for f in iter_files(src) if f != manifest_file)
+    root = os.path.dirname(src) if os.path.isfile(src) else src
+    stats = {f: os.stat(os.path.join(root, f)) for f in files}
+    digests = hash_tree(src, threads=threads) if checksum else {}
+
+    entries = {}
+    changed = []
+    for f in files:
+        st = stats[f]
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        if checksum:
+            entry["hash"] = digests[f]
+        old = manifest.get(f, None)
+        if old is None or not os.path.exists(os.path.join(dest, f)):
+            changed.append(f)
+        elif checksum and old.get("hash", None) != entry["hash"]:
+            changed.append(f)
+        elif not checksum and (old["size"], old["mtime"]) != (entry["size"], entry["mtime"]):
+            changed.append(f)
+        entries[f] = entry
+
+    copy_tree(root, dest, files=changed, threads=threads)
+
+    removed = []
+    if delete:
+        # we only ever remove files that we synced in the first place
+        for f in manifest:
+            if f not in entries:
+                try:
+                    os.remove(os.path.join(dest, f))
+                except FileNotFoundError:
+                    pass
+                removed.append(f)
+
+    os.makedirs(dest, exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as m:
+        json.dump(entries, m)
+    os.replace(tmp_path, manifest_path)
+
+    changed_set = set(changed)
+    return {
+        "copied": changed,
+        "skipped": [f for f in files if f not in changed_set],
+        "deleted": removed
+    }
+
+class RunCache:
+    """
+    Content-addressed store of script outputs, keyed on the script source,
+    its declared inputs and `sys.argv`, so that re-running an unchanged script
+    just restores what it wrote last time.
+    Entries are evicted least-recently-used once the store goes over `max_size` bytes.
+    Unreferenced objects are only removed once they're `grace` seconds old, since another
+    process may have just stored them and not written its entry yet.
+    """
+    def __init__(self, root=None, max_size=2**31, grace=300):
+        if root is None:
+            root = get_cache_dir("runs")
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.entries_dir = os.path.join(root, "entries")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.entries_dir, exist_ok=True)
+        self.max_size = max_size
+        self.grace = grace
+
+    def get_key(self, script, argv, inputs=(), outputs=()):
+        """
+        Hashes everything that determines what the script writes
+
+        :param script: path to the script
+        :type script: str
+        :param argv: the `sys.argv` the script will see
+        :type argv: list[str]
+        :param inputs: declared input files or directories
+        :type inputs: Iterable[str]
+        :param outputs: declared outputs, since they determine what gets stored
+        :type outputs: Iterable[str]
+        :return:
+        :rtype: str
+        """
+        hasher = hashlib.sha256()
+        hasher.update(get_image_version().encode())
+        hasher.update(hash_file(script).encode())
+        for path in sorted(inputs):
+            if not os.path.exists(path):
+                raise IOError("declared input {} doesn't exist".format(path))
+            hasher.update(json.dumps([path, hash_tree(path)], sort_keys=True).encode())
+        hasher.update(json.dumps([list(argv), sorted(outputs)]).encode())
+        return hasher.hexdigest()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def entry_path(self, key):
+        return os.path.join(self.entries_dir, key + ".json")
+
+    def restore(self, key):
+        """
+        Copies the outputs for `key` back into place
+
+        :return: the restored files or `None` on a miss
+        :rtype: list[str] | None
+        """
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path) as e:
+                entry = json.load(e)
+        except (OSError, ValueError):
+            return None
+        files = entry["files"]
+        # entries with no files are left over from runs that didn't declare any outputs
+        if len(files) == 0 or not all(os.path.exists(self.object_path(d)) for d in files.values()):
+            return None
+        for path, digest in files.items():
+            copy_file(self.object_path(digest), path)
+        # bump the entry for LRU
+        os.utime(entry_path)
+        return list(files.keys())
+
+    def store(self, key, outputs):
+        """
+        Adds the files in `outputs` to the store under `key`
+
+        :return: the stored files
+        :rtype: list[str]
+        """
+        files = {}
+        for out in outputs:
+            if not os.path.exists(out):
+                raise IOError("declared output {} doesn't exist".format(out))
+            for f, digest in hash_tree(out).items():
+                path = out if os.path.isfile(out) else os.path.join(out, f)
+                obj = self.object_path(digest)
+                try:
+                    # marks existing objects as fresh so `evict` leaves them alone
+                    os.utime(obj)
+                except FileNotFoundError:
+                    tmp = "{}.{}.tmp".format(obj, os.getpid())
+                    copy_file(path, tmp)
+                    os.replace(tmp, obj)
+                    # `copy_file` keeps the source mtime
+                    os.utime(obj)
+                files[path] = digest
+        entry_path = self.entry_path(key)
+        tmp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+        with open(tmp_path, 'w') as e:
+            json.dump({"files": files}, e)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+        return list(files.keys())
+
+    def evict(self):
+        """
+        Drops least-recently-used entries until the objects they
+        reference fit in `max_size`, then removes unreferenced objects
+        """
+        entries = []
+        for name in os.listdir(self.entries_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.entries_dir, name)
+            try:
+                with open(path) as e:
+                    digests = set(json.load(e)["files"].values())
+                entries.append((os.stat(path).st_mtime, path, digests))
+            except (OSError, ValueError, KeyError):
+                continue
+        entries.sort(key=lambda e: e[0], reverse=True)
+
+        sizes = {}
+        for _, _, digests in entries:
+            for d in digests:
+                if d not in sizes:
+                    try:
+                        sizes[d] = os.stat(self.object_path(d)).st_size
+                    except FileNotFoundError:
+                        sizes[d] = 0
+        keep = set()
+        total = 0
+        for i, (_, path, digests) in enumerate(entries):
+            new = digests - keep
+            extra = sum(sizes[d] for d in new)
+            # always keep the most recent entry, even if it's too big on its own
+            if i > 0 and total + extra > self.max_size:
+                os.remove(path)
+                continue
+            keep |= new
+            total += extra
+
+        cutoff = time.time() - self.grace
+        for sub in os.listdir(self.objects_dir):
+            sub_dir = os.path.join(self.objects_dir, sub)
+            for digest in os.listdir(sub_dir):
+                if digest in keep:
+                    continue
+                obj = os.path.join(sub_dir, digest)
+                try:
+                    # new objects (or temp files) may belong to a store that's still going
+                    if os.stat(obj).st_mtime > cutoff:
+                        continue
+                    os.remove(obj)
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def run(self, script, fn, argv=None, inputs=(), outputs=()):
+        """
+        Calls `fn` unless there's a cached result for this `script`, `argv`, and `inputs`,
+        storing `outputs` after a successful run
+
+        :return: whether we had a cache hit
+        :rtype: bool
+        """
+        if argv is None:
+            argv = sys.argv
+        outputs = list(outputs)
+        if len(outputs) == 0:
+            # a hit would skip the script without restoring anything
+            raise ValueError("can't cache {} without any declared outputs (--cache-outputs)".format(script))
+        key = self.get_key(script, argv, inputs=inputs, outputs=outputs)
+        restored = self.restore(key)
+        if restored is not None:
+            print("Restored {} cached outputs for {}".format(len(restored), script))
+            return True
+        fn()
+        self.store(key, outputs)
+        return False
+
+class ModulePreloader:
+    """
+    Imports a list of (slow) modules in a background thread and drops them into
+    a namespace as they finish so that interactive sessions start right away.
+    Modules are given as `name` or `name:alias`, e.g. `tensorflow:tf`
+    """
+    def __init__(self, modules, namespace):
+        self.modules = modules
+        self.namespace = namespace
+        self.loaded = []
+        self.errors = {}
+        self.thread = None
+
+    @classmethod
+    def parse_modules(cls, spec):
+        """
+        Splits a comma-separated `name[:alias]` list
+        """
+        mods = []
+        for m in spec.split(","):
+            m = m.strip()
+            if m == "":
+                continue
+            name, _, alias = m.partition(":")
+            mods.append((name, alias if alias != "" else name.split(".")[0]))
+        return mods
+
+    def load(self):
+        for name, alias in self.modules:
+            try:
+                mod = importlib.import_module(name)
+            except Exception as e:
+                self.errors[name] = "{}: {}".format(type(e).__name__, e)
+                continue
+            if alias == name.split(".")[0]:
+                # `import a.b` binds `a`
+                mod = sys.modules[alias]
+            # don't clobber anything the user already defined
+            self.namespace.setdefault(alias, mod)
+            self.loaded.append(name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.load, daemon=True, name="mcenv-preload")
+        self.thread.start()
+        return self
+
+    @property
+    def done(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until everything has been imported
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.done
+
+    def __repr__(self):
+        return "{}(loaded={}, pending={}, errors={})".format(
+            type(self).__name__,
+            self.loaded,
+            [n for n, _ in self.modules if n not in self.loaded and n not in self.errors],
+            self.errors
+        )
+
+class MPIContext:
+    """
+    Thin wrapper over an `mpi4py` communicator that's handed to `--mpi` scripts
+    as `__mpi__` so that shared inputs get read once on the root and
+    work can be split up without every rank hitting the filesystem
+    """
+    def __init__(self, comm=None, root=0):
+        if comm is None:
+            try:
+                from mpi4py import MPI
+            except ImportError:
+                raise ImportError("--mpi mode requires mpi4py")
+            comm = MPI.COMM_WORLD
+        self.comm = comm
+        self.root = root
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+        self.inputs = {}
+
+    @property
+    def is_root(self):
+        return self.rank == self.root
+
+    def bcast(self, obj=None):
+        """
+        Broadcasts `obj` from the root to every rank
+        """
+        return self.comm.bcast(obj if self.is_root else None, root=self.root)
+
+    def bcast_call(self, fn, *args, **kwargs):
+        """
+        Calls `fn` on the root and broadcasts the result.
+        If it fails the error is broadcast instead and raised on every rank,
+        so the other ranks don't sit in `bcast` waiting on a root that's gone
+        """
+        res = None
+        if self.is_root:
+            try:
+                res = ('ok', fn(*args, **kwargs))
+            except Exception as e:
+                res = ('error', "{}: {}".format(type(e).__name__, e))
+        status, value = self.bcast(res)
+        if status == 'error':
+            raise IOError("failed on the root rank: {}".format(value))
+        return value
+
+    def call_on_root(self, fn, *args, **kwargs):
+        """
+        Like `bcast_call` but only whether `fn` worked gets broadcast, not its result
+
+        :return: what `fn` returned on the root, `None` elsewhere
+        """
+        value = error = None
+        if self.is_root:
+            try:
+                value = fn(*args, **kwargs)
+            except Exception as e:
+                error = "{}: {}".format(type(e).__name__, e)
+        error = self.bcast(error)
+        if error is not None:
+            raise IOError("failed on the root rank: {}".format(error))
+        return value
+
+    def read_shared(self, *paths, mode='rb'):
+        """
+        Reads `paths` on the root only and broadcasts the contents
+
+        :return: map from path to contents
+        :rtype: dict
+        """
+        def read():
+            data = {}
+            for p in paths:
+                with open(p, mode) as f:
+                    data[p] = f.read()
+            return data
+        return self.bcast_call(read)
+
+    def scatter(self, items=None):
+        """
+        Splits `items` (only needed on the root) into
+        contiguous, roughly even chunks and sends one to each rank
+
+        :return: this rank's chunk
+        :rtype: list
+        """
+        def split():
+            data = list(items)
+            n, r = divmod(len(data), self.size)
+            chunks = []
+            start = 0
+            for i in range(self.size):
+                stop = start + n + (1 if i < r else 0)
+                chunks.append(data[start:stop])
+                start = stop
+            return chunks
+        return self.comm.scatter(self.call_on_root(split), root=self.root)
+
+    def gather(self, items, flatten=True):
+        """
+        Collects every rank's `items` on the root, concatenated in rank order
+        if `flatten`
+
+        :return: the gathered items on the root, `None` elsewhere
+        :rtype: list | None
+        """
+        res = self.comm.gather(items, root=self.root)
+        if flatten:
+            res = self.call_on_root(lambda: [x for chunk in res for x in chunk])
+        return res
+
+    def map(self, fn, items=None):
+        """
+        Scatters `items`, applies `fn` on every rank, and gathers the results on the root.
+        If `fn` fails on any rank, every rank raises
+        """
+        chunk = self.scatter(items)
+        try:
+            res = ('ok', [fn(x) for x in chunk])
+        except Exception as e:
+            res = ('error', "{}: {}".format(type(e).__name__, e))
+        res = self.gather(res, flatten=False)
+        errors = None
+        if self.is_root:
+            errors = ["rank {}: {}".format(i, v) for i, (status, v) in enumerate(res) if status == 'error']
+        errors = self.bcast(errors)
+        if len(errors) > 0:
+            raise IOError("failed on {}".format("; ".join(errors)))
+        if self.is_root:
+            return [x for _, out in res for x in out]
+
+    def output_path(self, path):
+        """
+        Tags `path` with the rank so that every rank writes its own file
+        """
+        base, ext = os.path.splitext(path)
+        return "{}.rank{}{}".format(base, self.rank, ext)
+
+class CommandRegistry:
+    """
+    Index of the CLI command groups, covering both the `cli_method_` methods on the CLI
+    and plugins that ship an `mcenv_commands.py` module in a package under `packages_dir`.
+    Plugins are read (not imported) into a cached manifest that gets rebuilt when
+    the packages change, so a plugin module is only imported once one of its commands is run.
+
+    A plugin module defines `cli_method_<group>_<command>(cli)` functions and
+    can list its groups in `command_groups` if they contain underscores.
+    """
+    plugin_module = "mcenv_commands"
+
+    def __init__(self, cli_class, packages_dir, manifest_path=None):
+        self.cli_class = cli_class
+        self.packages_dir = packages_dir
+        if manifest_path is None:
+            tag = hashlib.sha1(os.path.abspath(packages_dir).encode()).hexdigest()[:12]
+            manifest_path = os.path.join(get_cache_dir("commands", get_image_version()), tag + ".json")
+        self.manifest_path = manifest_path
+        self._builtins = None
+        self._plugins = None
+
+    @staticmethod
+    def split_name(name, prefix, groups=()):
+        """
+        Splits `cli_method_<group>_<cmd>` into `(group, cmd)`, preferring the declared `groups`
+        """
+        rest = name[len(prefix):]
+        for g in sorted(groups, key=len, reverse=True):
+            if rest.startswith(g + "_"):
+                return g, rest[len(g)+1:].replace("_", "-")
+        group, _, cmd = rest.partition("_")
+        return group, cmd.replace("_", "-")
+
+    @property
+    def builtins(self):
+        if self._builtins is None:
+            prefix = self.cli_class.command_prefix
+            commands = {}
+            for cls in reversed(self.cli_class.__mro__):
+                for k, v in vars(cls).items():
+                    if k.startswith(prefix) and callable(v):
+                        group, cmd = self.split_name(k, prefix, self.cli_class.command_groups)
+                        commands.setdefault(group, {})[cmd] = {"attr": k, "doc": v.__doc__}
+            self._builtins = commands
+        return self._builtins
+
+    def get_stamps(self):
+        """
+        Returns the mtimes of the packages dir and the package dirs inside it,
+        since adding/removing a plugin module changes the mtime of its package
+        """
+        stamps = {}
+        try:
+            stamps[self.packages_dir] = os.stat(self.packages_dir).st_mtime_ns
+            with os.scandir(self.packages_dir) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        stamps[entry.path] = entry.stat().st_mtime_ns
+        except OSError:
+            pass
+        return stamps
+
+    def read_plugin(self, path):
+        """
+        Pulls the command names and docs out of a plugin module without importing it
+        """
+        import ast
+
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read(), path)
+        groups = []
+        functions = []
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and any(
+                    isinstance(t, ast.Name) and t.id == "command_groups" for t in node.targets
+            ):
+                try:
+                    groups = list(ast.literal_eval(node.value))
+                except ValueError:
+                    pass
+            elif isinstance(node, ast.FunctionDef) and node.name.startswith(self.cli_class.command_prefix):
+                functions.append((node.name, ast.get_docstring(node)))
+        commands = {}
+        for name, doc in functions:
+            group, cmd = self.split_name(name, self.cli_class.command_prefix, groups)
+            commands.setdefault(group, {})[cmd] = {"attr": name, "doc": doc}
+        return commands
+
+    def scan_plugins(self, stamps):
+        plugins = {}
+        for pkg_dir in sorted(stamps):
+            if pkg_dir == self.packages_dir:
+                continue
+            path = os.path.join(pkg_dir, self.plugin_module + ".py")
+            if not os.path.isfile(path):
+                continue
+            try:
+                commands = self.read_plugin(path)
+            except (OSError, SyntaxError, ValueError):
+                continue
+            plugins[path] = {
+                "module": os.path.basename(pkg_dir) + "." + self.plugin_module,
+                "mtime": os.stat(path).st_mtime_ns,
+                "commands": commands
+            }
+        return plugins
+
+    def load_manifest(self):
+        """
+        Returns the cached plugin index if nothing has changed since it was written
+        """
+        try:
+            with open(self.manifest_path) as m:
+                manifest = json.load(m)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("stamps") != self.get_stamps():
+            return None
+        for path, plugin in manifest["plugins"].items():
+            try:
+                if os.stat(path).st_mtime_ns != plugin["mtime"]:
+                    return None
+            except OSError:
+                return None
+        return manifest["plugins"]
+
+    @property
+    def plugins(self):
+        if self._plugins is None:
+            plugins = self.load_manifest()
+            if plugins is None:
+                stamps = self.get_stamps()
+                plugins = self.scan_plugins(stamps)
+                try:
+                    tmp_path = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+                    with open(tmp_path, 'w') as m:
+                        json.dump({"stamps": stamps, "plugins": plugins}, m)
+                    os.replace(tmp_path, self.manifest_path)
+                except OSError:
+                    pass
+            self._plugins = plugins
+        return self._plugins
+
+    def groups(self):
+        """
+        Returns all the command groups, built-ins first
+
+        :return: map from group to map from command to info
+        :rtype: dict
+        """
+        groups = {g: dict(c) for g, c in self.builtins.items()}
+        for path, plugin in self.plugins.items():
+            for g, commands in plugin["commands"].items():
+                group = groups.setdefault(g, {})
+                for cmd, info in commands.items():
+                    # built-ins always win
+                    group.setdefault(cmd, dict(info, module=plugin["module"], path=path))
+        return groups
+
+    def get(self, group, cmd):
+        """
+        Returns the info for `group cmd`, looking at plugins only if it's not a built-in
+        """
+        cmd = cmd.replace("_", "-")
+        info = self.builtins.get(group, {}).get(cmd, None)
+        if info is None:
+            info = self.groups().get(group, {}).get(cmd, None)
+        return info
+
+    def load(self, info, cli):
+        """
+        Returns the callable for a command, importing the plugin module if need be
+        """
+        if "module" not in info:
+            return getattr(cli, info["attr"])
+        try:
+            mod = importlib.import_module(info["module"])
+        except ImportError:
+            name = info["module"].replace(".", "_")
+            spec = importlib.util.spec_from_file_location(name, info["path"])
+            mod = importlib.util.module_from_spec(spec)
+            sys.modules[name] = mod
+            spec.loader.exec_module(mod)
+        fn = getattr(mod, info["attr"])
+        return lambda: fn(cli)
+
+class CLI:
+
+    command_prefix='cli_method_'
+    command_groups=['files']
+    __env__ = ""
+    packages_dir = os.path.join("/", "home", "packages")
+    scripts_dir = os.path.join("/", "home", "scripts")
+
+    def __init__(self, group=None, command=None):
+        if group is None or command is None:
+            self.argv = sys.argv
+            parser = argparse.ArgumentParser()
+            parser.add_argument("group", type=str)
+            parser.add_argument("command", type=str, default='', nargs="?")
+            parse, unknown = parser.parse_known_args()
+            self.group = parse.group
+            self.cmd = parse.command
+            sys.argv = [sys.argv[0]] + unknown
+        else:
+            self.group = group
+            self.cmd = command
+
+    _parsers = {}
+    _registry = None
+
+    @classmethod
+    def get_registry(cls):
+        if cls._registry is None:
+            cls._registry = CommandRegistry(cls, cls.packages_dir)
+        return cls._registry
+
+    @staticmethod
+    def get_parse_dict(*spec):
+        # the parser only depends on the spec, so build it once per process
+        cache_key = repr(spec)
+        parser, keys = CLI._parsers.get(cache_key, (None, None))
+        argv_0 = sys.argv[0]
+        try:
+            sys.argv[0] = "parsing_dict" #self.group + " " + self.cmd
+            if parser is None:
+                parser = argparse.ArgumentParser()
+                keys = []
+                for arg in spec:
+                    if len(arg) > 1:
+                        arg_name, arg_dict = arg
+                    else:
+                        arg_name = arg[0]
+                        arg_dict = {}
+                    if 'dest' in arg_dict:
+                        keys.append(arg_dict['dest'])
+                    else:
+                        keys.append(arg_name)
+                    parser.add_argument(arg_name, **arg_dict)
+                CLI._parsers[cache_key] = (parser, keys)
+            args = parser.parse_args()
+            opts = {k: getattr(args, k) for k in keys}
+        finally:
+            sys.argv[0] = argv_0
+        return {k:o for k,o in opts.items() if not (isinstance(o, str) and o=="")}
+
+    def get_command(self, group=None, cmd=None):
+        if group is None:
+            group = self.group
+        if cmd is None:
+            cmd = self.cmd
+        registry = self.get_registry()
+        info = registry.get(group, cmd)
+        if info is None:
+            fun = "Unknown command '{}' for command group '{}'".format(cmd.replace("_", "-"), group)
+        else:
+            fun = registry.load(info, self)
+        return fun
+
+    def get_help(self):
+        from collections import OrderedDict
+
+        registry = self.get_registry()
+        if self.group == "":
+            all_groups = registry.groups()
+            names = [g for g in self.command_groups if g in all_groups]
+            names += sorted(g for g in all_groups if g not in names)
+            groups = OrderedDict((g, all_groups[g]) for g in names)
+        else:
+            groups = OrderedDict([(self.group, registry.groups().get(self.group, {}))])
+
+        indent="    "
+        template = "{group}:\n{commands}"
+        if self.cmd != "":
+            template = "{group}{commands}"
+            indent = "  "
+            info = registry.get(self.group, self.cmd)
+            if info is None:
+                info = {"doc": "Unknown command '{}' for command group '{}'".format(self.cmd, self.group)}
+            groups[self.group] = {self.cmd: info}
+
+        blocks = []
+        make_command_info = lambda name, doc, indent: "{0}{1}{3}{0}  {2}".format(
+            indent,
+            name,
+            "" if doc is None else doc.strip(),
+            "\n" if doc is not None else ""
+            )
+        for g in groups:
+            blocks.append(
+                template.format(
+                    group = g,
+                    commands = "\n".join(make_command_info(k, info["doc"], indent) for k, info in groups[g].items())
+                )
+            )
+        return "\n\n".join(blocks)
+
+    def cli_method_files_precompile(self):
+        """
+        Compiles the packages and scripts directories and the CLI itself (or the given paths) into the bytecode cache
+        """
+        import compileall
+
+        parse = self.get_parse_dict(
+            ("paths", dict(nargs="*", default=[])),
+            ("--workers", dict(default=0, type=int, dest="workers"))
+        )
+        paths = parse['paths']
+        if len(paths) == 0:
+            source_dir = os.path.dirname(os.path.abspath(__file__))
+            paths = [d for d in [self.packages_dir, self.scripts_dir, source_dir] if os.path.isdir(d)]
+        workers = parse['workers']
+        if workers <= 0:
+            workers = get_core_count()
+        # compile into the same layout `CachedBytecodeLoader` reads from,
+        # with the env var for workers that get spawned rather than forked
+        prefix = sys.pycache_prefix
+        env_prefix = os.environ.get("PYTHONPYCACHEPREFIX", None)
+        if self.pycache_dir is not None:
+            sys.pycache_prefix = self.pycache_dir
+            os.environ["PYTHONPYCACHEPREFIX"] = self.pycache_dir
+        print("Compiling {} into {} with {} workers".format(paths, sys.pycache_prefix, workers))
+        success = True
+        try:
+            for path in paths:
+                success = compileall.compile_dir(path, quiet=1, workers=workers) and success
+        finally:
+            sys.pycache_prefix = prefix
+            if env_prefix is None:
+                os.environ.pop("PYTHONPYCACHEPREFIX", None)
+            else:
+                os.environ["PYTHONPYCACHEPREFIX"] = env_prefix
+        if not success:
+            raise IOError("failed to compile some files in {}".format(paths))
+        return success
+
+    def cli_method_files_copy(self):
+        """
+        Copies SRC into DEST in parallel
+        """
+        parse = self.get_parse_dict(
+            ("src",),
+            ("dest",),
+            ("--threads", dict(default=0, type=int, dest="threads"))
+        )
+        size = copy_tree(parse['src'], parse['dest'], threads=parse['threads'])
+        print("Copied {} bytes from {} to {}".format(size, parse['src'], parse['dest']))
+        return size
+
+    def cli_method_files_sync(self):
+        """
+        Syncs SRC into DEST, skipping files that haven't changed since the last sync
+        """
+        parse = self.get_parse_dict(
+            ("src",),
+            ("dest",),
+            ("--threads", dict(default=0, type=int, dest="threads")),
+            ("--checksum", dict(default=False, action='store_const', const=True, dest="checksum")),
+            ("--delete", dict(default=False, action='store_const', const=True, dest="delete"))
+        )
+        res = sync_tree(parse['src'], parse['dest'],
+                        threads=parse['threads'],
+                        checksum=parse['checksum'],
+                        delete=parse['delete']
+                        )
+        print("Synced {} to {}: {} copied, {} unchanged, {} deleted".format(
+            parse['src'], parse['dest'], len(res['copied']), len(res['skipped']), len(res['deleted'])
+        ))
+        return res
+
+    def cli_method_files_hash(self):
+        """
+        Hashes all the files in PATH in parallel
+        """
+        parse = self.get_parse_dict(
+            ("path",),
+            ("--threads", dict(default=0, type=int, dest="threads")),
+            ("--algorithm", dict(default='sha256', type=str, dest="algorithm"))
+        )
+        digests = hash_tree(parse['path'], threads=parse['threads'], algorithm=parse['algorithm'])
+        for f, h in digests.items():
+            print("{}  {}".format(h, f))
+        return digests
+
+    def run(self):
+        res = self.get_command()
+        if not isinstance(res, str):
+            res = res()
+        else:
+            print(res)
+        return res
+
+    def help(self, print_help=True):
+        if len(sys.argv) > 1:
+            sys.argv.pop(1)
+        res = self.get_help()
+        if print_help:
+            print(res)
+        return res
+
+    def __getstate__(self):
+        """ Do nothing """
+        return {}
+    def __setstate__(self):
+        """ Do nothing """
+        pass
+    pycache_dir = None
+    @classmethod
+    def configure_pycache(cls):
+        """
+        Points the bytecode cache for the `packages` and `scripts` trees at a per-user,
+        per-image directory.
+        Everything else (e.g. the image's precompiled stdlib) is left alone
+        """
+        cls.pycache_dir = configure_pycache([cls.packages_dir, cls.scripts_dir])
+        return cls.pycache_dir
+
+    @classmethod
+    def resolve_script(cls, script):
+        """
+        Finds a script either relative to the cwd or in the scripts directory
+        """
+        if not os.path.exists(script):
+            script = os.path.join(cls.scripts_dir, script)
+        return script
+
+    @classmethod
+    def load_script_module(cls, script, init_globals=None):
+        """
+        Imports a script as a proper module (registered in `sys.modules`)
+        so that its functions can be pickled over to pool workers
+        """
+        sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+        name = os.path.splitext(os.path.basename(script))[0]
+        spec = importlib.util.spec_from_file_location(name, script)
+        set_script_module(name, spec, {} if init_globals is None else init_globals)
+        mod = sys.modules[name]
+        spec.loader.exec_module(mod)
+        return mod
+
+    @classmethod
+    def run_map(cls):
+        """
+        Loads a script once and maps its entry function over the tasks in a JSONL file
+        using a process pool, streaming the results out to a JSONL file as they finish
+        """
+        import multiprocessing as mp
+
+        parse = cls.get_parse_dict(
+            ("script",),
+            ("tasks",),
+            ("--output", dict(default="", type=str, dest="output")),
+            ("--entry", dict(default="main", type=str, dest="entry")),
+            ("--procs", dict(default=0, type=int, dest="procs")),
+            ("--chunksize", dict(default=1, type=int, dest="chunksize")),
+            ("--resume", dict(default=False, action='store_const', const=True, dest="resume"))
+        )
+        script = cls.resolve_script(parse['script'])
+        tasks_file = parse['tasks']
+        output = parse.get('output', os.path.splitext(tasks_file)[0] + ".results.jsonl")
+        procs = parse['procs'] if parse['procs'] > 0 else get_core_count()
+
+        # figure out what's already been done so we can pick up where we left off,
+        # dropping the failed runs (and any line we died halfway through) since those get redone
+        done = set()
+        mode = "w"
+        if parse['resume'] and os.path.exists(output):
+            mode = "a"
+            tmp = "{}.{}.tmp".format(output, os.getpid())
+            with open(output) as out, open(tmp, "w") as kept:
+                for line in out:
+                    try:
+                        res = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "error" not in res and res["task"] not in done:
+                        done.add(res["task"])
+                        kept.write(json.dumps(res) + "\n")
+            os.replace(tmp, output)
+
+        mod = cls.load_script_module(script, init_globals={"__env__": "__script__"})
+        if not hasattr(mod, parse['entry']):
+            raise ValueError("script {} has no entry function '{}'".format(script, parse['entry']))
+
+        def iter_tasks():
+            with open(tasks_file) as tf:
+                for i, line in enumerate(tf):
+                    if line.strip() == "" or i in done:
+                        continue
+                    yield (mod.__name__, parse['entry'], i, json.loads(line))
+
+        completed = 0
+        errors = 0
+        with open(output, mode) as out:
+            with mp.Pool(procs) as pool:
+                for res in pool.imap_unordered(run_map_task, iter_tasks(), chunksize=parse['chunksize']):
+                    out.write(json.dumps(res) + "\n")
+                    out.flush()
+                    completed += 1
+                    if "error" in res:
+                        errors += 1
+        print("Ran {} tasks ({} errors, {} skipped) with {} processes; results in {}".format(
+            completed, errors, len(done), procs, output
+        ))
+
+    @classmethod
+    def run_mpi(cls, parse):
+        """
+        Runs a script on every MPI rank, where the root resolves and reads the script
+        (and any `--mpi-inputs`) and broadcasts them out, and where each rank can optionally
+        write its output to its own file in `--mpi-output`
+        """
+        import contextlib
+
+        mpi = MPIContext()
+        def load_spec():
+            script = cls.resolve_script(sys.argv[1])
+            with open(script) as f:
+                src = f.read()
+            inputs = [p for p in parse.mpi_inputs.split(",") if p != ""]
+            return (script, src, inputs)
+        script, src, inputs = mpi.bcast_call(load_spec)
+        mpi.inputs = mpi.read_shared(*inputs)
+        sys.argv.pop(0)
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+        name = os.path.splitext(os.path.basename(script))[0]
+        spec = importlib.util.spec_from_loader(name, loader=None, origin=script)
+        set_script_module(name, spec, {"__env__": "__script__", "__file__": script, "__mpi__": mpi})
+        code = compile(src, script, 'exec')
+
+        with contextlib.ExitStack() as stack:
+            if parse.mpi_output != "":
+                os.makedirs(parse.mpi_output, exist_ok=True)
+                out_file = os.path.join(parse.mpi_output, mpi.output_path(name + ".out"))
+                out = stack.enter_context(open(out_file, 'w'))
+                stack.enter_context(contextlib.redirect_stdout(out))
+                stack.enter_context(contextlib.redirect_stderr(out))
+            exec(code, vars(sys.modules[name]))
+
+    @classmethod
+    def run_command(cls, parse):
+        # detect whether interactive run or not
+        interact = parse.interact or (len(sys.argv) == 1 and not parse.help and not parse.script)
+
+        # in interactive/script envs we expose stuff
+        if parse.script or interact:
+             sys.path.insert(0, os.getcwd())
+             interactive_env = {
+                 "__env__": "__script__"
+                }
+        # start pulling in the heavy modules while the script/prompt starts up
+        if interact and parse.preload != "":
+            interactive_env["__preload__"] = ModulePreloader(
+                ModulePreloader.parse_modules(parse.preload),
+                interactive_env
+            ).start()
+        # in a script environment we just read in the script and run it
+        if parse.map:
+            cls.run_map()
+        elif parse.mpi:
+            cls.run_mpi(parse)
+        elif parse.script:
+            script = cls.resolve_script(sys.argv[1])
+            sys.argv.pop(0)
+            sys.path.insert(0, os.path.dirname(script))
+            script_mod=os.path.splitext(os.path.basename(script))[0]
+            # importlib.import_module(script_mod)
+            interactive_env["__name__"] = os.path.splitext(os.path.basename(script))[0]
+            run_script = lambda: runpy.run_module(script_mod, init_globals={"__env__":"__script__"})
+            if parse.cache:
+                cache = RunCache(max_size=int(parse.cache_size * 2**20))
+                cache.run(script, run_script,
+                          inputs=[p for p in parse.cache_inputs.split(",") if p != ""],
+                          outputs=[p for p in parse.cache_outputs.split(",") if p != ""]
+                          )
+            else:
+                run_script()
+            # with open(script) as scr:
+            #     src = scr.read()
+            #     src = compile(src, script, 'exec')
+            # interactive_env["__file__"] = script
+            # exec(src, interactive_env, interactive_env)
+        elif parse.help:
+            if len(sys.argv) == 1:
+                print("mcenv [--interact|--script] GRP CMD [ARGS] runs something in McEnv with the specified command")
+                print("mcenv --mpi [--mpi-inputs=F1,F2] [--mpi-output=DIR] SCRIPT [ARGS] runs SCRIPT on every MPI rank")
+                print("mcenv --map SCRIPT TASKS [--output OUT] [--entry FN] [--procs N] [--resume] maps SCRIPT over a JSONL task file")
+                print("mcenv --script --cache [--cache-inputs=F1,F2] [--cache-outputs=O1,O2] SCRIPT [ARGS] restores OUTPUTS if SCRIPT, INPUTS and ARGS are unchanged")
+            group = sys.argv[1] if len(sys.argv) > 1 else ""
+            command = sys.argv[2] if len(sys.argv) > 2 else ""
+            CLI(group=group, command=command).help()
+        elif len(sys.argv) > 1:
+            CLI().run()
+        if interact:
+            import code
+            banner = "McEnv Interactive Session"
+            if "__preload__" in interactive_env:
+                banner += "\n(loading {} in the background, see `__preload__`)".format(
+                    ", ".join(n for n, _ in interactive_env["__preload__"].modules)
+                )
+            code.interact(banner=banner, readfunc=None, local=interactive_env, exitmsg=None)
+
+    @classmethod
+    def run_parse(cls, parse, unknown):
+        sys.argv = [sys.argv[0]] + unknown
+        # print(sys.argv)
+        cls.run_command(parse)
+
+    @classmethod
+    def parse_and_run(cls):
+        cls.configure_pycache()
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument("--interact", default=False, action='store_const', const=True, dest="interact",
+                            help='start an interactive session after running'
+                            )
+        parser.add_argument("--script", default=False, action='store_const', const=True, dest="script",
+                            help='run a script'
+                            )
+        parser.add_argument("--map", default=False, action='store_const', const=True, dest="map",
+                            help='map a script over a task file'
+                            )
+        parser.add_argument("--mpi", default=False, action='store_const', const=True, dest="mpi",
+                            help='run a script across MPI ranks'
+                            )
+        parser.add_argument("--mpi-inputs", default="", type=str, dest="mpi_inputs",
+                            help='comma-separated files to read on the root rank and broadcast'
+                            )
+        parser.add_argument("--mpi-output", default="", type=str, dest="mpi_output",
+                            help='directory for per-rank output files'
+                            )
+        parser.add_argument("--cache", default=False, action='store_const', const=True, dest="cache",
+                            help='reuse the outputs of a previous identical --script run'
+                            )
+        parser.add_argument("--cache-inputs", default="", type=str, dest="cache_inputs",
+                            help='comma-separated files or directories the script reads'
+                            )
+        parser.add_argument("--cache-outputs", default="", type=str, dest="cache_outputs",
+                            help='comma-separated files or directories the script writes'
+                            )
+        parser.add_argument("--cache-size", default=float(os.environ.get("MCENV_RUN_CACHE_SIZE", 2048)), type=float,
+                            dest="cache_size",
+                            help='max size of the run cache in MB'
+                            )
+        parser.add_argument("--preload", default=os.environ.get("MCENV_PRELOAD", ""), type=str, dest="preload",
+                            help='comma-separated modules (as name or name:alias) to import in the background in interactive sessions'
+                            )
+        parser.add_argument("--help", default=False, action='store_const', const=True, dest="help")
+        parser.add_argument("--fulltb", default=False, action='store_const', const=True, dest="full_traceback")
+        new_argv = []
+        for k in sys.argv[1:]:
+            if not k.startswith("--"):
+                break
+            new_argv.append(k)
+        unknown = sys.argv[1+len(new_argv):]
+        sys.argv = [sys.argv[0]]+new_argv
+        parse = parser.parse_args()
+
+        if parse.full_traceback:
+            cls.run_parse(parse, unknown)
+        else:
+            error = None
+            try:
+                cls.run_parse(parse, unknown)
+            except Exception as e:
+                error = e
+            if error is not None:
+                print(error)
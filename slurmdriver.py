@@ -3,16 +3,202 @@ Tiny python script that can run in the background and submit SLURM jobs when the
 to file by delegating to `subprocess.call`
 """
 
-import json, subprocess, os, threading, time, abc
+import json, subprocess, os, sys, threading, time, abc
 import pathlib, hashlib # folder server
-import socket, base64, re # socket server
-import datetime, argparse, code # client setup
+import socket, base64, re, select # socket server
+import datetime, argparse, code, codecs # client setup
+import collections, itertools, shlex, multiprocessing # task farm
+import sqlite3 # accounting cache
+import random # rate limiting
+import zlib # payload compression
+import queue, importlib # worker pool
+import shutil, fcntl # git mirrors
+
+def _get_payload_codecs():
+    codecs = collections.OrderedDict()
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        codecs['zstd'] = (
+            lambda data:zstandard.ZstdCompressor().compress(data),
+            lambda data:zstandard.ZstdDecompressor().decompress(data)
+        )
+    codecs['zlib'] = (zlib.compress, zlib.decompress)
+    return codecs
+# supported compression for job/result payloads, in order of preference
+payload_codecs = _get_payload_codecs()
+# leading bytes that flag compressed job files
+payload_magic = {b"\x28\xb5\x2f\xfd":'zstd', b"\x78":'zlib'}
+compression_threshold = 2**12
+def encode_payload(obj, encodings=(), threshold=None):
+    """
+    Dumps `obj` to JSON and compresses it with the first of `encodings`
+    we support if it's over `threshold` bytes
+
+    :return: the encoding used (`None` if uncompressed) and the bytes
+    :rtype: (str | None, bytes)
+    """
+    if threshold is None:
+        threshold = compression_threshold
+    data = json.dumps(obj).encode('ascii')
+    if len(data) >= threshold:
+        for enc in encodings:
+            if enc in payload_codecs:
+                return enc, payload_codecs[enc][0](data)
+    return None, data
+def decode_payload(data, encoding=None):
+    """
+    Inverse of `encode_payload`
+    """
+    if encoding is not None:
+        data = payload_codecs[encoding][1](data)
+    return json.loads(data)
+def wrap_payload(obj, brackets, encodings=(), threshold=None):
+    """
+    Encodes `obj` as a base-64 blob wrapped in `brackets`,
+    with the compression (if any) tagged on the front like `[zlib:...]`
+    """
+    encoding, data = encode_payload(obj, encodings=encodings, threshold=threshold)
+    body = base64.b64encode(data).decode('ascii')
+    if encoding is not None:
+        body = encoding + ":" + body
+    return brackets[0] + body + brackets[1]
+def unwrap_payload(block):
+    """
+    Inverse of `wrap_payload`
+    """
+    body = block[1:-1]
+    encoding = None
+    if ":" in body:
+        encoding, body = body.split(":", 1)
+    return decode_payload(base64.b64decode(body), encoding)
+def split_frames(buffer, close):
+    """
+    Splits off everything up to the last complete `wrap_payload` blob so a
+    payload that arrives over several `recv` calls isn't lost
+
+    :return: the complete part and the leftover partial blob
+    :rtype: (str, str)
+    """
+    end = buffer.rfind(close) + 1
+    return buffer[:end], buffer[end:]
+def read_payload_file(path):
+    """
+    Loads a job file, which is either plain JSON or compressed JSON
+    flagged by its magic bytes
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    for magic, encoding in payload_magic.items():
+        if data.startswith(magic):
+            return decode_payload(data, encoding)
+    return decode_payload(data)
+
+def is_buffer_like(obj):
+    """
+    Checks if `obj` is an array or a `memoryview`, which is how endpoints ask for
+    other binary data to be sent back as a buffer (plain `bytes` are sent as text like always)
+    """
+    return hasattr(obj, '__array_interface__') or isinstance(obj, memoryview)
+def _create_shared_block(data):
+    from multiprocessing import shared_memory
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1), track=False)
+    except TypeError:
+        # before 3.13 the resource tracker would unlink it out from under the client
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.buf[:data.nbytes] = data
+    name = shm.name
+    shm.close()
+    return name
+def _shared_block_path(name):
+    return os.path.join("/dev/shm", name.lstrip("/"))
+def _release_shared_block(name):
+    """
+    Unlinks a block if the client hasn't already taken it
+
+    :return: whether the block was still there
+    :rtype: bool
+    """
+    try:
+        os.remove(_shared_block_path(name))
+    except FileNotFoundError:
+        return False
+    return True
+def _attach_shared_block(name, nbytes):
+    import mmap
+    # we map the segment directly so that the mapping lives exactly as long
+    # as whatever array ends up wrapping it
+    path = _shared_block_path(name)
+    with open(path, 'r+b') as f:
+        block = mmap.mmap(f.fileno(), 0)
+    # the client owns the block, so once it's mapped we can drop the name
+    os.remove(path)
+    return memoryview(block)[:nbytes]
+def pack_buffer(obj, shared=False, shm_threshold=2**16):
+    """
+    Packs an array as a dtype/shape header plus its raw bytes, which either go inline
+    as base-64 or, for clients on the same host, into a shared-memory block that the
+    client takes ownership of
+
+    :param obj:
+    :type obj: np.ndarray | bytes | memoryview
+    :param shared: whether to use shared memory
+    :type shared: bool
+    :param shm_threshold: buffers smaller than this many bytes always go inline
+    :type shm_threshold: int
+    :return:
+    :rtype: dict
+    """
+    if hasattr(obj, 'dtype'):
+        import numpy as np
+        obj = np.ascontiguousarray(obj)
+        header = {"dtype":obj.dtype.str, "shape":list(obj.shape)}
+        data = memoryview(obj).cast('B')
+    else:
+        data = memoryview(obj)
+        header = {"dtype":data.format, "shape":list(data.shape)}
+        if not data.c_contiguous:
+            data = memoryview(data.tobytes())
+        data = data.cast('B')
+    header['nbytes'] = data.nbytes
+    if shared and data.nbytes >= shm_threshold:
+        header['shm'] = _create_shared_block(data)
+    else:
+        header['data'] = base64.b64encode(data).decode('ascii')
+    return {"__buffer__":header}
+def unpack_buffer(packed):
+    """
+    Inverse of `pack_buffer`, giving back a NumPy array if NumPy is around
+    and a `memoryview` otherwise
+    """
+    header = packed['__buffer__']
+    if 'shm' in header:
+        data = _attach_shared_block(header['shm'], header['nbytes'])
+    else:
+        data = memoryview(base64.b64decode(header['data']))
+    try:
+        import numpy as np
+    except ImportError:
+        try:
+            return data.cast(header['dtype'], header['shape'])
+        except (TypeError, ValueError):
+            # non-native format, so just hand back the raw bytes
+            return dict(header, data=data)
+    else:
+        return np.frombuffer(data, dtype=header['dtype']).reshape(header['shape'])
 
 class EndPoint:
     """
     Simple named end point spec that can be called.
     Mostly just to provide a base class
     """
+    # whether big outputs can be sent back as a `ResultSpool` handle
+    spool_results = True
     def __init__(self, name):
         self.name = name
     @abc.abstractmethod
@@ -27,12 +213,110 @@ class EndPoint:
         :rtype:
         """
 
+class RateLimiter:
+    """
+    Token-bucket rate limiter for a scheduler command.
+    Transient SLURM errors (controller timeouts and the like) get retried
+    with jittered exponential backoff, and each one halves the send rate,
+    which then creeps back up by `recovery` per success
+    """
+    transient_errors = [
+        "Socket timed out on send/recv",
+        "Unable to contact slurm controller",
+        "Slurm temporarily unable to accept job",
+        "Resource temporarily unavailable",
+        "Zero Bytes were transmitted or received",
+        "Communication connection failure",
+        "Connection refused",
+        "backup controller in standby mode"
+    ]
+    def __init__(self, rate=5, burst=10, min_rate=.1, recovery=.1, retries=5, backoff=1, max_backoff=60):
+        """
+        :param rate: max calls per second
+        :type rate: float
+        :param burst: max calls that can go out at once
+        :type burst: int
+        :param min_rate: floor for the adaptive rate
+        :type min_rate: float
+        :param recovery: how much the rate goes back up per success
+        :type recovery: float
+        :param retries: how many times to retry a transient error
+        :type retries: int
+        :param backoff: base backoff in seconds
+        :type backoff: float
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+    def acquire(self):
+        """
+        Blocks until a token is available
+        """
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+    def is_transient(self, error, transient_errors=None):
+        if transient_errors is None:
+            transient_errors = self.transient_errors
+        msg = str(error)
+        return any(t in msg for t in transient_errors)
+    def slow_down(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+    def speed_up(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery)
+    def call(self, fn, *args, transient_errors=None, **kwargs):
+        """
+        Calls `fn` once a token is available, retrying transient errors
+        (or just the ones in `transient_errors` if passed)
+        """
+        for attempt in range(self.retries + 1):
+            self.acquire()
+            try:
+                res = fn(*args, **kwargs)
+            except IOError as e:
+                if attempt == self.retries or not self.is_transient(e, transient_errors):
+                    raise
+                self.slow_down()
+                delay = min(self.max_backoff, self.backoff * 2**attempt)
+                print("WARNING: transient scheduler error, retrying in <{:.1f}s:\n{}".format(delay, e))
+                time.sleep(random.uniform(0, delay))
+            else:
+                self.speed_up()
+                return res
+
 class SubprocessEndPoint(EndPoint):
     """
     Endpoint that just calls a binary on the
-    system
+    system, optionally through a `RateLimiter`
     """
+    def __init__(self, name, rate_limiter=None):
+        super().__init__(name)
+        self.rate_limiter = rate_limiter
+    # errors that are safe to retry, `None` means anything the limiter thinks is transient
+    retry_errors = None
     def __call__(self, *args, **kwargs):
+        if self.rate_limiter is None:
+            return self.run(*args, **kwargs)
+        else:
+            return self.rate_limiter.call(self.run, *args, transient_errors=self.retry_errors, **kwargs)
+    def run(self, *args, **kwargs):
         runny = subprocess.run(
             [self.name, *args],
             check=False,
@@ -52,6 +336,173 @@ class SubprocessEndPoint(EndPoint):
         if out is not None:
             out = out.decode().splitlines()
         return out
+    # output can be streamed to a `ResultSpool`
+    spoolable = True
+    def call_spooled(self, spool_file, *args, **kwargs):
+        if self.rate_limiter is None:
+            return self.run_spooled(spool_file, *args, **kwargs)
+        else:
+            return self.rate_limiter.call(self.run_spooled, spool_file, *args,
+                                          transient_errors=self.retry_errors, **kwargs)
+    def run_spooled(self, spool_file, *args, **kwargs):
+        """
+        Like `run` but with stdout going straight into `spool_file`
+        so large outputs never have to sit in memory
+        """
+        spool_file.seek(0)
+        spool_file.truncate()
+        runny = subprocess.run(
+            [self.name, *args],
+            check=False,
+            stdout=spool_file,
+            stderr=subprocess.PIPE,
+            **kwargs
+            )
+        spool_file.seek(0, os.SEEK_END)
+        if runny.returncode > 0:
+            out = runny.stderr.decode()
+            if len(out) == 0:
+                spool_file.seek(0)
+                out = spool_file.read(2**16).decode('utf-8', 'replace')
+            raise IOError(out)
+
+class SbatchEndPoint(SubprocessEndPoint):
+    """
+    `sbatch` endpoint that registers the jobs it submits
+    with a `JobWatcher`
+    """
+    job_id_regex = re.compile(r"Submitted batch job (\d+)|^(\d+)(?:;\S+)?$")
+    # needs the output to pull out the job ID
+    spoolable = False
+    # submitting isn't idempotent, so we only retry when the controller definitely
+    # never took the job (a timeout might have come after it was queued)
+    retry_errors = [
+        "Slurm temporarily unable to accept job",
+        "Unable to contact slurm controller",
+        "Connection refused",
+        "backup controller in standby mode"
+    ]
+    def __init__(self, name='sbatch', watcher=None, rate_limiter=None):
+        super().__init__(name, rate_limiter=rate_limiter)
+        self.watcher = watcher
+    @classmethod
+    def parse_job_id(cls, lines):
+        """
+        Pulls the job ID out of the `sbatch` output (either the normal or `--parsable` form)
+        """
+        for line in lines:
+            match = cls.job_id_regex.search(line.strip())
+            if match is not None:
+                return match.group(1) or match.group(2)
+    def __call__(self, *args, **kwargs):
+        out = super().__call__(*args, **kwargs)
+        if self.watcher is not None:
+            job_id = self.parse_job_id(out)
+            if job_id is not None:
+                self.watcher.track(job_id)
+        return out
+
+class WorkflowEndPoint(EndPoint):
+    """
+    Endpoint that submits a whole DAG of `sbatch` jobs in one request,
+    wiring up the `--dependency` flags on the driver side.
+    The workflow is a dict (or JSON string) mapping node names to either
+    a list of `sbatch` arguments or a dict like
+    `{"args": [...], "after": [node, ...], "dependency": "afterok"}`,
+    where the arguments can also be given as a single shell-quoted string
+    """
+    def __init__(self, name='workflow', sbatch=None, max_workers=8):
+        super().__init__(name)
+        if sbatch is None:
+            sbatch = SbatchEndPoint('sbatch')
+        self.sbatch = sbatch
+        self.max_workers = max_workers
+    @staticmethod
+    def prep_nodes(spec):
+        """
+        Normalizes the node specs and checks that the graph is a DAG
+        before anything gets submitted
+        """
+        if isinstance(spec, str):
+            spec = json.loads(spec)
+        if not isinstance(spec, dict):
+            raise ValueError("workflow should map node names to specs, got {}".format(type(spec).__name__))
+        nodes = {}
+        for name, node in spec.items():
+            if not isinstance(node, dict):
+                node = {"args":node}
+            args = node.get("args", None)
+            if isinstance(args, str):
+                args = shlex.split(args)
+            elif not isinstance(args, (list, tuple)):
+                raise ValueError("node '{}' args should be a list or string, got {}".format(
+                    name, type(args).__name__
+                ))
+            after = node.get("after", [])
+            if isinstance(after, str):
+                after = [after]
+            node = dict(node, args=[str(a) for a in args], after=list(after))
+            for dep in node['after']:
+                if dep not in spec:
+                    raise ValueError("node '{}' depends on unknown node '{}'".format(name, dep))
+            nodes[name] = node
+        # Kahn's algorithm just to make sure we can actually get through everything
+        indegree = {n:len(node['after']) for n, node in nodes.items()}
+        frontier = [n for n, d in indegree.items() if d == 0]
+        visited = 0
+        while len(frontier) > 0:
+            n = frontier.pop()
+            visited += 1
+            for m, node in nodes.items():
+                if n in node['after']:
+                    indegree[m] -= 1
+                    if indegree[m] == 0:
+                        frontier.append(m)
+        if visited < len(nodes):
+            raise ValueError("workflow has a dependency cycle")
+        return nodes
+    def submit_node(self, node, dep_ids):
+        args = node['args']
+        if len(dep_ids) > 0:
+            args = ["--dependency={}:{}".format(node.get('dependency', 'afterok'), ":".join(dep_ids))] + args
+        job_id = SbatchEndPoint.parse_job_id(self.sbatch(*args))
+        if job_id is None:
+            raise IOError("couldn't get a job ID from sbatch {}".format(args))
+        return job_id
+    def __call__(self, spec):
+        """
+        Submits the nodes in topological order, with independent nodes submitted in parallel
+
+        :return: map from node name to job ID
+        :rtype: dict
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        nodes = self.prep_nodes(spec)
+        remaining = set(nodes.keys())
+        job_ids = {}
+        errors = {}
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = {}
+            while True:
+                ready = [n for n in remaining if all(d in job_ids for d in nodes[n]['after'])]
+                for n in ready:
+                    remaining.discard(n)
+                    dep_ids = [job_ids[d] for d in nodes[n]['after']]
+                    futures[pool.submit(self.submit_node, nodes[n], dep_ids)] = n
+                if len(futures) == 0:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for f in done:
+                    n = futures.pop(f)
+                    try:
+                        job_ids[n] = f.result()
+                    except Exception as e:
+                        errors[n] = str(e)
+        if len(errors) > 0:
+            # anything left in `remaining` was downstream of a failure
+            raise IOError(json.dumps({"jobs":job_ids, "errors":errors, "skipped":sorted(remaining)}))
+        return job_ids
 
 class PythonEndPoint(EndPoint):
     """
@@ -80,13 +531,950 @@ class ExecEndPoint(EndPoint):
     def __call__(self, *args, **kwargs):
         exec(*args, **kwargs)
 
+class MethodEndPoint(EndPoint):
+    """
+    Endpoint that calls straight into a python callable,
+    mostly so driver-side objects can expose their methods
+    """
+    def __init__(self, name, method):
+        super().__init__(name)
+        self.method = method
+    def __call__(self, *args, **kwargs):
+        return self.method(*args, **kwargs)
+
+class TaskFarm:
+    """
+    Driver-side queue of `mcenv` tasks for pilot jobs.
+    Clients submit tasks and a single allocation runs a `PilotWorker` per core (or node)
+    which pulls tasks as it frees up and reports the results back, so lots of small
+    tasks don't each have to go through the SLURM queue.
+    Handed out tasks are leased for `lease` seconds and go back on the queue if
+    the worker doesn't renew or report them in time (e.g. because its node died)
+    """
+    def __init__(self, prefix='farm', lease=600):
+        """
+        :param lease: how long a worker can hold a task without checking in
+        :type lease: float
+        """
+        self.prefix = prefix
+        self.lease = lease
+        self.pending = collections.deque()
+        self.running = {}
+        self.results = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+    def submit(self, *tasks):
+        """
+        Queues up tasks, each of which is a string of arguments to `mcenv`
+
+        :return: the task ids
+        :rtype: list
+        """
+        ids = []
+        with self._lock:
+            for task in tasks:
+                task_id = str(next(self._counter))
+                self.pending.append((task_id, task))
+                ids.append(task_id)
+        return ids
+    def pull(self, worker, count=1):
+        """
+        Hands out up to `count` tasks to `worker`
+
+        :return: list of `[task_id, task]` pairs
+        :rtype: list
+        """
+        tasks = []
+        with self._lock:
+            self._requeue_expired()
+            now = time.time()
+            while len(self.pending) > 0 and len(tasks) < int(count):
+                task_id, task = self.pending.popleft()
+                self.running[task_id] = {"worker":worker, "task":task, "start":now, "expires":now + self.lease}
+                tasks.append([task_id, task])
+        return tasks
+    def renew(self, worker, *task_ids):
+        """
+        Extends the leases `worker` holds on `task_ids`
+
+        :return: the task ids that are still leased to `worker`
+        :rtype: list
+        """
+        renewed = []
+        with self._lock:
+            expires = time.time() + self.lease
+            for task_id in task_ids:
+                info = self.running.get(task_id, None)
+                if info is not None and info['worker'] == worker:
+                    info['expires'] = expires
+                    renewed.append(task_id)
+        return renewed
+    def _requeue_expired(self):
+        # called with the lock held
+        now = time.time()
+        expired = sorted(
+            (info['start'], task_id) for task_id, info in self.running.items()
+            if info['expires'] < now
+        )
+        # put them back at the front, oldest first
+        for _, task_id in reversed(expired):
+            info = self.running.pop(task_id)
+            self.pending.appendleft((task_id, info['task']))
+    def report(self, task_id, result):
+        """
+        Records the result of a task, passed as a dict or JSON string
+        """
+        if isinstance(result, str):
+            result = json.loads(result)
+        with self._lock:
+            if task_id in self.results:
+                # a worker that lost its lease finished anyway
+                return task_id
+            info = self.running.pop(task_id, None)
+            if info is None:
+                # requeued but not handed out again yet
+                for entry in self.pending:
+                    if entry[0] == task_id:
+                        self.pending.remove(entry)
+                        break
+            else:
+                result['task'] = info['task']
+                result['worker'] = info['worker']
+                result['elapsed'] = time.time() - info['start']
+            self.results[task_id] = result
+        return task_id
+    def status(self):
+        """
+        Returns the number of pending, running, and finished tasks
+        """
+        with self._lock:
+            self._requeue_expired()
+            return {"pending":len(self.pending), "running":len(self.running), "done":len(self.results)}
+    def collect(self, *task_ids):
+        """
+        Returns (and drops) the results for `task_ids` or all finished tasks if none are passed
+        """
+        with self._lock:
+            if len(task_ids) == 0:
+                task_ids = list(self.results.keys())
+            return {t:self.results.pop(t) for t in task_ids if t in self.results}
+    def endpoints(self):
+        """
+        Returns the endpoints clients and workers use to talk to the farm
+        """
+        return [
+            MethodEndPoint(self.prefix + "_submit", self.submit),
+            MethodEndPoint(self.prefix + "_pull", self.pull),
+            MethodEndPoint(self.prefix + "_renew", self.renew),
+            MethodEndPoint(self.prefix + "_report", self.report),
+            MethodEndPoint(self.prefix + "_status", self.status),
+            MethodEndPoint(self.prefix + "_collect", self.collect)
+        ]
+
+class JobWatcher:
+    """
+    Tracks the SLURM jobs submitted through the driver and refreshes all of their
+    states with one `squeue` call (plus one `sacct` call for jobs that have left the queue)
+    every `interval` seconds.
+    Clients read state changes off the event feed instead of each polling the controller,
+    so the load on SLURM doesn't scale with the number of clients watching
+    """
+    final_states = {
+        'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY',
+        'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE',
+        # left the queue but `sacct` couldn't tell us how it ended
+        'UNKNOWN'
+    }
+    def __init__(self, squeue=None, sacct=None, interval=30, prefix='watch', max_events=10000, retention=60*60):
+        """
+        :param retention: how long to remember jobs after they finish
+        :type retention: float
+        """
+        if squeue is None:
+            squeue = SubprocessEndPoint('squeue')
+        if sacct is None:
+            sacct = SubprocessEndPoint('sacct')
+        self.squeue = squeue
+        self.sacct = sacct
+        self.interval = interval
+        self.prefix = prefix
+        self.retention = retention
+        self.states = {}
+        self._finished = {}
+        self.events = collections.deque(maxlen=max_events)
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._active = False
+        self._thread = None
+    def _set_state(self, job_id, state):
+        old = self.states.get(job_id, None)
+        if old != state:
+            self._cursor += 1
+            self.events.append({
+                "cursor":self._cursor,
+                "time":time.time(),
+                "job":job_id,
+                "old":old,
+                "new":state
+            })
+            self.states[job_id] = state
+            if state in self.final_states:
+                self._finished[job_id] = time.time()
+    def _prune(self):
+        # called with the lock held
+        cutoff = time.time() - self.retention
+        for job_id, stamp in list(self._finished.items()):
+            if stamp < cutoff:
+                del self._finished[job_id]
+                self.states.pop(job_id, None)
+    def track(self, *job_ids):
+        """
+        Starts tracking `job_ids`
+        """
+        with self._lock:
+            for j in job_ids:
+                if j not in self.states:
+                    self._set_state(j, 'SUBMITTED')
+    def query(self, job_ids):
+        """
+        Looks up the states of `job_ids` in a single batch
+
+        :return: map from job ID to state
+        :rtype: dict
+        """
+        states = {}
+        try:
+            out = self.squeue('-h', '-j', ",".join(job_ids), '-o', '%i %T')
+        except IOError as e:
+            # squeue errors out if none of the jobs are still in the queue,
+            # anything else we can't tell apart from jobs that left the queue
+            if "Invalid job id" not in str(e):
+                raise
+            out = []
+        for line in out:
+            bits = line.split()
+            if len(bits) == 2 and bits[0] in job_ids:
+                states[bits[0]] = bits[1]
+        missing = [j for j in job_ids if j not in states]
+        if len(missing) > 0:
+            try:
+                out = self.sacct('-n', '-X', '-P', '-j', ",".join(missing), '-o', 'JobID,State')
+            except IOError as e:
+                # e.g. accounting storage is disabled
+                print("WARNING: sacct failed for jobs that left the queue:\n{}".format(e))
+                out = []
+            for line in out:
+                bits = line.split("|")
+                if len(bits) == 2 and bits[0] in missing:
+                    # e.g. 'CANCELLED by 1234'
+                    states[bits[0]] = bits[1].split()[0]
+            # otherwise we'd keep asking about them forever
+            for j in missing:
+                states.setdefault(j, 'UNKNOWN')
+        return states
+    def refresh(self):
+        """
+        Updates the states of all the unfinished jobs
+        """
+        with self._lock:
+            self._prune()
+            active = [j for j, s in self.states.items() if s not in self.final_states]
+        if len(active) > 0:
+            states = self.query(active)
+            with self._lock:
+                for j, s in states.items():
+                    self._set_state(j, s)
+    def watch_loop(self):
+        while self._active:
+            try:
+                self.refresh()
+            except Exception as e:
+                print("ERROR: job watcher refresh failed:\n{}".format(e))
+            time.sleep(self.interval)
+    def start(self):
+        """
+        Starts the refresh loop on a background thread
+        """
+        if self._thread is None:
+            self._active = True
+            self._thread = threading.Thread(target=self.watch_loop, daemon=True)
+            self._thread.start()
+    def stop(self):
+        self._active = False
+        self._thread = None
+    def subscribe(self, *job_ids):
+        """
+        Tracks `job_ids` (even if they weren't submitted through the driver)
+        and returns their current states along with the cursor to read events from
+        """
+        self.track(*job_ids)
+        with self._lock:
+            return {
+                "cursor":self._cursor,
+                "states":{j:self.states[j] for j in job_ids}
+            }
+    def get_events(self, cursor=0, *job_ids):
+        """
+        Returns the state changes after `cursor`, optionally restricted to `job_ids`
+        """
+        cursor = int(cursor)
+        job_ids = set(job_ids)
+        with self._lock:
+            events = [
+                e for e in self.events
+                if e['cursor'] > cursor and (len(job_ids) == 0 or e['job'] in job_ids)
+            ]
+            return {"cursor":self._cursor, "events":events}
+    def get_states(self, *job_ids):
+        """
+        Returns the last known states of `job_ids` (or all tracked jobs)
+        """
+        with self._lock:
+            if len(job_ids) == 0:
+                return dict(self.states)
+            return {j:self.states.get(j, None) for j in job_ids}
+    def endpoints(self):
+        return [
+            MethodEndPoint(self.prefix + "_subscribe", self.subscribe),
+            MethodEndPoint(self.prefix + "_events", self.get_events),
+            MethodEndPoint(self.prefix + "_states", self.get_states)
+        ]
+
+class AccountingCache:
+    """
+    Local SQLite cache of `sacct` records.
+    Each sync only asks `sacct` for jobs active since the last sync (the high-water mark),
+    and aggregate queries are answered out of the cache so wide time windows don't
+    keep getting pulled from slurmdbd
+    """
+    fields = ['JobID', 'User', 'State', 'Partition', 'Submit', 'Start', 'End', 'ElapsedRaw', 'NCPUS', 'ExitCode']
+    columns = ['job_id', 'user', 'state', 'partition', 'submit', 'start', 'end', 'elapsed', 'ncpus', 'exit_code']
+    failed_states = {'FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'BOOT_FAIL', 'DEADLINE'}
+    def __init__(self, db_file, sacct=None, prefix='acct', all_users=True,
+                 overlap=300, initial_window=7*24*60*60, max_age=300):
+        """
+        :param db_file: where to keep the cache
+        :type db_file: str
+        :param overlap: how far before the high-water mark to re-query so late updates aren't missed
+        :type overlap: float
+        :param initial_window: how far back to go on the first sync
+        :type initial_window: float
+        :param max_age: how stale the cache can get before a query triggers a sync
+        :type max_age: float
+        """
+        if sacct is None:
+            sacct = SubprocessEndPoint('sacct')
+        self.sacct = sacct
+        self.prefix = prefix
+        self.all_users = all_users
+        self.overlap = overlap
+        self.initial_window = initial_window
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY, user TEXT, state TEXT, partition TEXT,
+                submit REAL, start REAL, end REAL, elapsed REAL, ncpus INTEGER, exit_code TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user);
+            CREATE INDEX IF NOT EXISTS jobs_submit ON jobs (submit);
+            CREATE INDEX IF NOT EXISTS jobs_end ON jobs (end);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+        """)
+        self.db.commit()
+    @staticmethod
+    def parse_time(stamp):
+        """
+        Converts a SLURM time stamp to epoch seconds
+        """
+        try:
+            return datetime.datetime.strptime(stamp, "%Y-%m-%dT%H:%M:%S").timestamp()
+        except ValueError:
+            # 'Unknown', 'None', etc.
+            return None
+    @staticmethod
+    def format_time(stamp):
+        return datetime.datetime.fromtimestamp(stamp).strftime("%Y-%m-%dT%H:%M:%S")
+    def parse_record(self, line):
+        bits = line.split("|")
+        if len(bits) != len(self.fields):
+            return None
+        job_id, user, state, partition, submit, start, end, elapsed, ncpus, exit_code = bits
+        return (
+            job_id, user, state.split()[0] if len(state) > 0 else state, partition,
+            self.parse_time(submit), self.parse_time(start), self.parse_time(end),
+            float(elapsed) if elapsed.isdigit() else None,
+            int(ncpus) if ncpus.isdigit() else None,
+            exit_code
+        )
+    @property
+    def high_water(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key='high_water'").fetchone()
+        return None if row is None else row[0]
+    def sync(self):
+        """
+        Pulls the records for all jobs active since the last sync into the cache
+
+        :return: the number of records updated
+        :rtype: int
+        """
+        with self._lock:
+            now = time.time()
+            high_water = self.high_water
+            if high_water is None:
+                since = now - self.initial_window
+            else:
+                since = high_water - self.overlap
+            args = ['-n', '-P', '-X', '-S', self.format_time(since), '-E', self.format_time(now),
+                    '-o', ",".join(self.fields)]
+            if self.all_users:
+                args = ['-a'] + args
+            records = [r for r in (self.parse_record(l) for l in self.sacct(*args)) if r is not None]
+            self.db.executemany(
+                "INSERT OR REPLACE INTO jobs VALUES ({})".format(",".join("?"*len(self.columns))),
+                records
+            )
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('high_water', ?)", (now,))
+            self.db.commit()
+        return len(records)
+    def _filters(self, user=None, since=None, until=None):
+        clauses = []
+        params = []
+        if user is not None:
+            clauses.append("user = ?")
+            params.append(user)
+        if since is not None:
+            clauses.append("submit >= ?")
+            params.append(self._as_time(since))
+        if until is not None:
+            clauses.append("submit < ?")
+            params.append(self._as_time(until))
+        where = "" if len(clauses) == 0 else "WHERE " + " AND ".join(clauses)
+        return where, params
+    def _as_time(self, stamp):
+        try:
+            return float(stamp)
+        except ValueError:
+            return datetime.datetime.fromisoformat(stamp).timestamp()
+    def runtime(self, user=None, since=None, until=None):
+        """
+        Job count, total and mean runtime (in seconds) per user
+        """
+        where, params = self._filters(user=user, since=since, until=until)
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT user, COUNT(*), SUM(elapsed), AVG(elapsed) FROM jobs {} GROUP BY user".format(where),
+                params
+            ).fetchall()
+        return {u:{"jobs":n, "total":tot, "mean":mean} for u, n, tot, mean in rows}
+    def failure_rate(self, user=None, since=None, until=None):
+        """
+        Fraction of finished jobs that failed per user
+        """
+        where, params = self._filters(user=user, since=since, until=until)
+        # jobs that are still pending or running haven't failed (or succeeded) yet
+        where = (where + " AND" if where != "" else "WHERE") + " end IS NOT NULL"
+        failed = ",".join("'{}'".format(s) for s in self.failed_states)
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT user, COUNT(*), SUM(state IN ({})) FROM jobs {} GROUP BY user".format(failed, where),
+                params
+            ).fetchall()
+        return {u:{"jobs":n, "failed":f, "rate":f/n} for u, n, f in rows}
+    def queue_wait(self, user=None, since=None, until=None, percentiles="50,90,99"):
+        """
+        Queue wait (start - submit) percentiles in seconds
+        """
+        where, params = self._filters(user=user, since=since, until=until)
+        where = (where + " AND" if where != "" else "WHERE") + " start IS NOT NULL AND submit IS NOT NULL"
+        with self._lock:
+            waits = [r[0] for r in self.db.execute(
+                "SELECT start - submit AS wait FROM jobs {} ORDER BY wait".format(where),
+                params
+            )]
+        res = {"jobs":len(waits)}
+        for p in str(percentiles).split(","):
+            if len(waits) > 0:
+                res["p"+p] = waits[min(len(waits) - 1, int(len(waits) * float(p) / 100))]
+            else:
+                res["p"+p] = None
+        return res
+    query_types = {'runtime':'runtime', 'failures':'failure_rate', 'wait':'queue_wait'}
+    def query(self, kind, *opts):
+        """
+        Runs a query of `kind` ('runtime', 'failures', or 'wait') with options passed
+        as `key=value`, syncing first if the cache is stale
+        """
+        if kind not in self.query_types:
+            raise ValueError("unknown query '{}'; valid queries {}".format(kind, list(self.query_types.keys())))
+        # `sync` updates this from other threads
+        with self._lock:
+            high_water = self.high_water
+        if high_water is None or time.time() - high_water > self.max_age:
+            self.sync()
+        kwargs = dict(o.split("=", 1) for o in opts)
+        return getattr(self, self.query_types[kind])(**kwargs)
+    def endpoints(self):
+        return [
+            MethodEndPoint(self.prefix + "_sync", self.sync),
+            MethodEndPoint(self.prefix + "_query", self.query)
+        ]
+
+class GitMirror:
+    """
+    Keeps a bare mirror of each git remote on local disk so deploying code into job
+    directories only has to pull new objects over the network once.
+    Concurrent syncs of the same remote are coalesced into a single fetch, and
+    job checkouts are cloned from the mirror with hardlinked (or shared) objects
+    """
+    def __init__(self, mirror_dir, git=None, prefix='git', max_age=0):
+        """
+        :param mirror_dir: where to keep the mirrors
+        :type mirror_dir: str
+        :param max_age: how long a fetch stays fresh enough for checkouts to skip syncing
+        :type max_age: float
+        """
+        if git is None:
+            git = SubprocessEndPoint('git')
+        self.git = git
+        self.mirror_dir = mirror_dir
+        self.prefix = prefix
+        self.max_age = max_age
+        self.synced = {}
+        self._fetches = {}
+        self._lock = threading.Lock()
+        os.makedirs(mirror_dir, exist_ok=True)
+    def mirror_path(self, remote):
+        name = re.sub(r"[^\w.-]+", "_", os.path.basename(remote.rstrip("/")))
+        if not name.endswith(".git"):
+            name += ".git"
+        return os.path.join(self.mirror_dir, hashlib.sha1(remote.encode()).hexdigest()[:12] + "-" + name)
+    def fetch(self, remote, path):
+        """
+        Creates or incrementally updates the mirror, holding a file lock
+        so separate drivers sharing `mirror_dir` don't fetch on top of each other
+        """
+        with open(path + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(path):
+                self.git("--git-dir", path, "remote", "update", "--prune")
+            else:
+                tmp = "{}.{}.tmp".format(path, os.getpid())
+                try:
+                    self.git("clone", "--mirror", "--quiet", remote, tmp)
+                    os.rename(tmp, path)
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+    def sync(self, remote):
+        """
+        Brings the mirror of `remote` up to date, waiting on an in-flight
+        fetch rather than starting a second one
+
+        :return: path to the mirror
+        :rtype: str
+        """
+        path = self.mirror_path(remote)
+        with self._lock:
+            pending = self._fetches.get(path, None)
+            owner = pending is None
+            if owner:
+                pending = {"done": threading.Event(), "error": None}
+                self._fetches[path] = pending
+        if not owner:
+            pending["done"].wait()
+            if pending["error"] is not None:
+                raise IOError(pending["error"])
+            return path
+        try:
+            self.fetch(remote, path)
+            self.synced[path] = time.time()
+        except Exception as e:
+            pending["error"] = str(e)
+            raise
+        finally:
+            with self._lock:
+                del self._fetches[path]
+            pending["done"].set()
+        return path
+    def checkout(self, remote, dest, ref="", shared="false"):
+        """
+        Creates a working copy of `remote` at `ref` in `dest` from the mirror,
+        hardlinking objects or, if `shared`, pointing at the mirror's objects directly.
+        `origin` is set back to `remote` so the checkout behaves like a normal clone
+
+        :return: the commit that was checked out
+        :rtype: str
+        """
+        path = self.mirror_path(remote)
+        if not os.path.isdir(path) or time.time() - self.synced.get(path, 0) > float(self.max_age):
+            self.sync(remote)
+        share = str(shared).lower() in ("1", "true", "yes")
+        # resolve against the mirror, since the clone only has non-default branches as `origin/<branch>`
+        ref = ref if ref != "" else "HEAD"
+        try:
+            commit = self.git("--git-dir", path, "rev-parse", "--verify", "--quiet", ref + "^{commit}")[0]
+        except IOError:
+            raise ValueError("no commit '{}' in {}".format(ref, remote))
+        self.git("clone", "--quiet", "--no-checkout", "--shared" if share else "--local", path, dest)
+        self.git("-C", dest, "remote", "set-url", "origin", remote)
+        self.git("-C", dest, "checkout", "--quiet", "--detach", commit)
+        return commit
+    def mirrors(self):
+        """
+        Lists the mirrored remotes and when they were last synced by this driver
+        """
+        res = {}
+        for name in sorted(os.listdir(self.mirror_dir)):
+            path = os.path.join(self.mirror_dir, name)
+            if not name.endswith(".git") or not os.path.isdir(path):
+                continue
+            remote = self.git("--git-dir", path, "config", "--get", "remote.origin.url")
+            res[remote[0] if remote else name] = {"path": path, "synced": self.synced.get(path, None)}
+        return res
+    def endpoints(self):
+        return [
+            MethodEndPoint(self.prefix + "_sync", self.sync),
+            MethodEndPoint(self.prefix + "_checkout", self.checkout),
+            MethodEndPoint(self.prefix + "_mirrors", self.mirrors)
+        ]
+
+def is_spool_handle(obj):
+    return isinstance(obj, dict) and '__spool__' in obj
+class ResultSpool:
+    """
+    Spools endpoint outputs that are too big to send in one message into files on the driver,
+    so the result only carries a handle and clients page through it with byte-range or line reads.
+    Subprocess output is streamed straight to disk, which caps what the driver holds per job at `threshold`
+    """
+    def __init__(self, spool_dir, threshold=2**15, page_size=2**18, max_age=60*60, prefix='spool', index_stride=1024):
+        """
+        :param spool_dir: where to put the spool files
+        :type spool_dir: str
+        :param threshold: outputs bigger than this many bytes get spooled
+        :type threshold: int
+        :param page_size: max bytes returned by a single read
+        :type page_size: int
+        :param max_age: how long unreleased spools are kept around
+        :type max_age: float
+        :param index_stride: how many lines between line-offset checkpoints
+        :type index_stride: int
+        """
+        self.spool_dir = spool_dir
+        self.threshold = threshold
+        self.page_size = page_size
+        self.max_age = max_age
+        self.prefix = prefix
+        self.index_stride = index_stride
+        self.entries = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+    def create(self, fmt='lines'):
+        """
+        Registers a new spool file
+
+        :return: the handle and the open file
+        :rtype: (str, BinaryIO)
+        """
+        self.expire()
+        handle = "{}-{}".format(os.getpid(), next(self._counter))
+        path = os.path.join(self.spool_dir, handle + ".spool")
+        with self._lock:
+            self.entries[handle] = {"path": path, "format": fmt, "created": time.time(), "index": [0]}
+        return handle, open(path, 'w+b')
+    def get_entry(self, handle):
+        with self._lock:
+            entry = self.entries.get(handle, None)
+        if entry is None:
+            raise ValueError("unknown or expired spool '{}'".format(handle))
+        return entry
+    def describe(self, handle):
+        """
+        Returns the handle that gets sent back in place of the output
+        """
+        entry = self.get_entry(handle)
+        return {"__spool__": handle, "format": entry["format"], "size": os.path.getsize(entry["path"])}
+    def release(self, *handles):
+        """
+        Drops spools once the client is done with them
+        """
+        for handle in handles:
+            with self._lock:
+                entry = self.entries.pop(handle, None)
+            if entry is not None:
+                try:
+                    os.remove(entry["path"])
+                except FileNotFoundError:
+                    pass
+        return list(handles)
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            stale = [h for h, e in self.entries.items() if now - e["created"] > self.max_age]
+        self.release(*stale)
+    def run(self, endpoint, *args):
+        """
+        Calls a `SubprocessEndPoint` with its stdout going to a spool file,
+        reading it back in if it turned out small
+
+        :return: the output lines or a spool handle
+        :rtype: list | dict
+        """
+        handle, f = self.create('lines')
+        try:
+            with f:
+                endpoint.call_spooled(f, *args)
+                size = f.tell()
+                if size <= self.threshold:
+                    f.seek(0)
+                    out = f.read().decode().splitlines()
+                    self.release(handle)
+                    return out
+        except Exception:
+            self.release(handle)
+            raise
+        return self.describe(handle)
+    def store(self, res, dump=None):
+        """
+        Spools an in-memory output, as lines if it's a list of strings and JSON otherwise
+        """
+        if isinstance(res, str):
+            fmt, data = 'text', res.encode()
+        elif isinstance(res, list) and all(isinstance(r, str) and "\n" not in r for r in res):
+            fmt, data = 'lines', "".join(r + "\n" for r in res).encode()
+        else:
+            fmt, data = 'json', (json.dumps(res) if dump is None else dump).encode()
+        handle, f = self.create(fmt)
+        with f:
+            f.write(data)
+        return self.describe(handle)
+    def read(self, handle, offset=0, size=0):
+        """
+        Reads up to `size` (capped at `page_size`) bytes starting at byte `offset`.
+        The data comes back as text with undecodable bytes (e.g. a split character)
+        surrogate-escaped so the client can rebuild the exact bytes
+        """
+        entry = self.get_entry(handle)
+        offset, size = int(offset), int(size)
+        if size <= 0 or size > self.page_size:
+            size = self.page_size
+        with open(entry["path"], 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+            total = os.fstat(f.fileno()).st_size
+        end = offset + len(data)
+        return {"data": data.decode('utf-8', 'surrogateescape'), "offset": end, "eof": end >= total}
+    def seek_line(self, entry, f, line):
+        """
+        Positions `f` at the start of `line` using the sparse checkpoint index,
+        extending the index as we scan past the end of it
+        """
+        index = entry["index"]
+        stride = self.index_stride
+        k = min(line // stride, len(index) - 1)
+        f.seek(index[k])
+        current = k * stride
+        while current < line:
+            if f.readline() == b"":
+                break
+            current += 1
+            if current % stride == 0 and current // stride == len(index):
+                index.append(f.tell())
+        return current
+    def lines(self, handle, start=0, count=0):
+        """
+        Reads up to `count` lines (or as many as fit if `count` is 0) starting at line `start`,
+        stopping early once `page_size` bytes have been read
+        """
+        entry = self.get_entry(handle)
+        start, count = int(start), int(count)
+        if count <= 0:
+            count = float('inf')
+        lines = []
+        nbytes = 0
+        with open(entry["path"], 'rb') as f:
+            current = self.seek_line(entry, f, start)
+            eof = False
+            while len(lines) < count and nbytes < self.page_size:
+                line = f.readline()
+                if line == b"":
+                    eof = True
+                    break
+                nbytes += len(line)
+                lines.append(line.decode('utf-8', 'replace').rstrip("\r\n"))
+            if not eof:
+                eof = f.read(1) == b""
+        return {"lines": lines, "start": start, "next": current + len(lines), "eof": eof}
+    def info(self, handle):
+        return self.describe(handle)
+    def endpoints(self):
+        endpoints = [
+            MethodEndPoint(self.prefix + "_read", self.read),
+            MethodEndPoint(self.prefix + "_lines", self.lines),
+            MethodEndPoint(self.prefix + "_info", self.info),
+            MethodEndPoint(self.prefix + "_release", self.release)
+        ]
+        # pages are already capped at `page_size`, and spooling them would just recurse
+        for e in endpoints:
+            e.spool_results = False
+        return endpoints
+
+def _get_rss():
+    """
+    Current resident memory of this process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+def _pool_worker_loop(conn, preload, memory_limit):
+    """
+    Main loop for `WorkerPool` processes
+    """
+    if memory_limit is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    for mod in preload:
+        try:
+            importlib.import_module(mod)
+        except ImportError as e:
+            print("WARNING: worker couldn't preload {}: {}".format(mod, e))
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        endpoint, args, kwargs, cwd = msg
+        try:
+            os.chdir(cwd)
+            reply = ('complete', endpoint(*args, **kwargs))
+        except BaseException as e:
+            reply = ('error', "{}: {}".format(type(e).__name__, e))
+        try:
+            conn.send((reply, _get_rss()))
+        except Exception as e:
+            # usually an unpicklable result
+            conn.send((('error', "couldn't send back result: {}".format(e)), _get_rss()))
+
+class WorkerPool:
+    """
+    Pool of pre-spawned worker processes with their imports already loaded,
+    so that CPU-heavy python endpoints don't hold the dispatcher's GIL and a crash
+    or leak only takes out a worker.
+    Workers get recycled after `max_jobs` jobs or once they're using more than `max_memory`,
+    and every job runs under a `job_memory` address-space limit and a `job_timeout`
+    """
+    def __init__(self, size=4, preload=(), max_jobs=100, max_memory=None, job_memory=None, job_timeout=None,
+                 context='spawn'):
+        """
+        :param size: number of worker processes
+        :type size: int
+        :param preload: modules to import in each worker when it starts
+        :type preload: Iterable[str]
+        :param max_jobs: jobs a worker runs before it's replaced
+        :type max_jobs: int
+        :param max_memory: resident memory (bytes) past which a worker is replaced
+        :type max_memory: int
+        :param job_memory: address-space limit (bytes) for each worker
+        :type job_memory: int
+        :param job_timeout: seconds a job can run before its worker is killed
+        :type job_timeout: float
+        """
+        self.ctx = multiprocessing.get_context(context)
+        self.preload = list(preload)
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.job_memory = job_memory
+        self.job_timeout = job_timeout
+        self._idle = queue.Queue()
+        for i in range(size):
+            self._idle.put(self._spawn())
+    def _spawn(self):
+        conn, child_conn = self.ctx.Pipe()
+        proc = self.ctx.Process(
+            target=_pool_worker_loop,
+            args=(child_conn, self.preload, self.job_memory),
+            daemon=True
+        )
+        proc.start()
+        child_conn.close()
+        return {"proc":proc, "conn":conn, "jobs":0}
+    def _retire(self, worker, kill=False):
+        if not kill:
+            try:
+                worker['conn'].send(None)
+            except OSError:
+                pass
+            worker['proc'].join(1)
+        if worker['proc'].is_alive():
+            worker['proc'].kill()
+            worker['proc'].join()
+        worker['conn'].close()
+    def run(self, endpoint, *args, **kwargs):
+        """
+        Runs `endpoint` in the next free worker
+        """
+        worker = self._idle.get()
+        try:
+            worker['conn'].send((endpoint, args, kwargs, os.getcwd()))
+        except (EOFError, OSError):
+            self._retire(worker, kill=True)
+            self._idle.put(self._spawn())
+            raise IOError("worker process died")
+        except:
+            # e.g. the job couldn't be pickled, so the worker never saw it
+            self._idle.put(worker)
+            raise
+        try:
+            finished = worker['conn'].poll(self.job_timeout)
+            if finished:
+                (status, res), rss = worker['conn'].recv()
+        except (EOFError, OSError):
+            self._retire(worker, kill=True)
+            self._idle.put(self._spawn())
+            raise IOError("worker process died")
+        if not finished:
+            self._retire(worker, kill=True)
+            self._idle.put(self._spawn())
+            raise TimeoutError("job killed after {}s".format(self.job_timeout))
+        worker['jobs'] += 1
+        if worker['jobs'] >= self.max_jobs or (self.max_memory is not None and rss > self.max_memory):
+            self._retire(worker)
+            worker = self._spawn()
+        self._idle.put(worker)
+        if status == 'error':
+            raise IOError(res)
+        return res
+    def shutdown(self):
+        while not self._idle.empty():
+            self._retire(self._idle.get())
+
+class PooledEndPoint(EndPoint):
+    """
+    Runs another endpoint in a `WorkerPool` process
+    instead of on a thread in the driver
+    """
+    def __init__(self, endpoint, pool):
+        super().__init__(endpoint.name)
+        self.endpoint = endpoint
+        self.pool = pool
+    def __call__(self, *args, **kwargs):
+        return self.pool.run(self.endpoint, *args, **kwargs)
+
 class JobServer(metaclass=abc.ABCMeta):
     """
     Minimal abstract job server that can listen for jobs and write results
     """
     @abc.abstractmethod
-    def get_jobs(self):
+    def get_jobs(self, timeout=None):
         """
+        :param timeout: how long to wait for new jobs, `None` to wait indefinitely
+        :type timeout: float | None
         :return:
         :rtype: Iterable[dict]
         """
@@ -123,6 +1511,8 @@ class TCPJobServer(JobServer):
         self._res_spec = res_spec
         self._connected = False
         self.chunk_size = 2**16
+        self._recv_buffer = ""
+        self._send_lock = threading.Lock()
 
     def bind(self):
         """
@@ -143,8 +1533,8 @@ class TCPJobServer(JobServer):
 
             self._connected = True
 
-    job_parser_regex = "\[[\w=+/]+\]"
-    def get_jobs(self):
+    job_parser_regex = "\[(?:\w+:)?[\w=+/]+\]"
+    def get_jobs(self, timeout=None):
         """
         Listens for a job or series of jobs to process
         as JSON
@@ -152,8 +1542,16 @@ class TCPJobServer(JobServer):
         :rtype:
         """
         self.bind()
+        if timeout is not None:
+            ready, _, _ = select.select([self._job_conn], [], [], timeout)
+            if len(ready) == 0:
+                return []
         # print("GETTING JOBS OFF SOCKET: (chunksize {})".format(self.chunk_size))
         request_block = self._job_conn.recv(self.chunk_size).decode('ascii')
+        if request_block == "" and timeout is not None:
+            # client hung up, so don't spin on the closed socket
+            time.sleep(timeout)
+        request_block, self._recv_buffer = split_frames(self._recv_buffer + request_block, "]")
 
         # jobs are sent as base-64 blobs wrapped in brackets
         if isinstance(self.job_parser_regex, str):
@@ -165,11 +1563,9 @@ class TCPJobServer(JobServer):
 
         jobs = []
         for req in requests:
-            req = req[1:-1]
             # print("GOT", req)
-            req = base64.b64decode(req)
             try:
-                job = json.loads(req)
+                job = unwrap_payload(req)
             except:
                 pass
             else:
@@ -179,61 +1575,112 @@ class TCPJobServer(JobServer):
 
     def write_result(self, res):
         """
+        Sends the result back, compressed if the client said it could handle it
         :param res:
         :type res: dict
         """
-        sub = base64.b64encode(json.dumps(res).encode('ascii')).decode('ascii')
-        sub = '{'+sub+'}'
+        res['server_encoding'] = list(payload_codecs.keys())
+        sub = wrap_payload(res, '{}', encodings=res.get('accept_encoding', []))
         self.bind()
         send_bytes = sub.encode('ascii')
-        if len(send_bytes) > self.chunk_size:
-            raise ValueError("job too large to be sent with default chunk size {} (for {})".format(self.chunk_size, res))
         # print("PUTTING RESULTS IN SOCKET: (chunksize {})".format(self.chunk_size))
-        self._res_conn.send(send_bytes)
+        with self._send_lock:
+            self._res_conn.sendall(send_bytes)
 
 class FolderJobServer(JobServer):
     """
-    JobServer that looks for JSON files in a folder
+    JobServer that looks for JSON files in a folder.
+    Only files that changed since the last scan get read and finished jobs
+    are moved to `job_archive` after `archive_age` seconds (by which point the client
+    should have picked up the result) so polling doesn't slow down as jobs pile up
     """
-
-    def __init__(self, job_source, job_archive):
+    final_statuses = {'complete', 'error', 'timeout'}
+    def __init__(self, job_source, job_archive, archive_age=60*60):
+        """
+        :param archive_age: how long finished job files stay around for clients to read
+        :type archive_age: float
+        """
         self.source = job_source
         self.archive = job_archive
+        self.archive_age = archive_age
         os.makedirs(self.source, exist_ok=True)
         os.makedirs(self.archive, exist_ok=True)
-        self.last_poll_time = None
-    def get_jobs(self):
+        # (mtime, size) of every file as of when we last read or wrote it
+        self._seen = {}
+        self._finished = {}
+    def get_jobs(self, timeout=None):
         """
-        Pulls jobs from job directory
+        Pulls jobs from job directory, sleeping for `timeout`
+        if there weren't any
         :return:
         :rtype: Iterable[dict]
         """
+        jobs = self._scan_jobs()
+        if len(jobs) == 0 and timeout is not None:
+            time.sleep(timeout)
+        return jobs
+    def _scan_jobs(self):
+        self._archive_finished()
         jobs = []
-        for f in os.listdir(self.source):
-            f = os.path.join(self.source, f)
-            if os.path.isfile(f) and (
-                    self.last_poll_time is None
-                    or os.stat(f).st_mtime > self.last_poll_time
-            ):
-                with open(f) as src:
-                    try:
-                        job = json.load(src)
-                    except:
-                        pass
-                    else:
-                        job['file'] = f
-                        jobs.append(f)
+        seen = {}
+        with os.scandir(self.source) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                f = entry.path
+                key = (st.st_mtime_ns, st.st_size)
+                if self._seen.get(f, None) == key:
+                    seen[f] = key
+                    continue
+                try:
+                    job = read_payload_file(f)
+                except:
+                    # probably caught it mid-write so we'll try again next time
+                    continue
+                seen[f] = key
+                job['file'] = f
+                jobs.append(job)
+        # drops files that went away on their own
+        self._seen = seen
         return jobs
+    def _archive_finished(self):
+        now = time.time()
+        for f, stamp in list(self._finished.items()):
+            if now - stamp > self.archive_age:
+                del self._finished[f]
+                self._seen.pop(f, None)
+                try:
+                    self.archive_job(f)
+                except FileNotFoundError:
+                    pass
     def write_job(self, job):
         """
-        Writes out a job to file
+        Writes out a job to file, compressed if it's large
+        and the client said it could handle it
         :param job:
         :type job:
         :return:
         :rtype:
         """
-        with open(job['file'], 'w') as jf:
-            json.dump(job, jf, indent=4)
+        encoding, data = encode_payload(job, encodings=job.get('accept_encoding', []))
+        if encoding is None:
+            with open(job['file'], 'w') as jf:
+                json.dump(job, jf, indent=4)
+        else:
+            with open(job['file'], 'wb') as jf:
+                jf.write(data)
+        # no need to read back our own writes
+        st = os.stat(job['file'])
+        self._seen[job['file']] = (st.st_mtime_ns, st.st_size)
+        if job.get('status', None) in self.final_statuses:
+            self._finished[job['file']] = time.time()
+        else:
+            # resubmitted under the same name
+            self._finished.pop(job['file'], None)
     write_result = write_job
     def archive_job(self, jobfile):
         """
@@ -254,20 +1701,126 @@ class FolderJobServer(JobServer):
         job_spec['status'] = 'running'
         self.write_result(job_spec)
 
+class FairShareQueue:
+    """
+    Priority queue for jobs with a per-client fair-share policy.
+    Interactive jobs always go ahead of batch jobs and, within a class,
+    the next job comes from the client with the least usage (the decayed runtime of
+    its recent jobs plus an estimate for what it has running), so that one client
+    flooding the driver can't starve everyone else
+    """
+    job_classes = ['interactive', 'batch']
+    def __init__(self, half_life=300):
+        """
+        :param half_life: how quickly (in seconds) past usage is forgotten
+        :type half_life: float
+        """
+        self.half_life = half_life
+        self.queues = {c:collections.OrderedDict() for c in self.job_classes}
+        self.usage = {}
+        self.running = collections.Counter()
+        self.mean_runtime = 1.
+        self._lock = threading.Lock()
+    @staticmethod
+    def get_client(job):
+        return job.get('client', 'anonymous')
+    def get_class(self, job):
+        job_class = job.get('priority', self.job_classes[0])
+        return job_class if job_class in self.queues else self.job_classes[0]
+    def get_usage(self, client, now=None):
+        if now is None:
+            now = time.time()
+        value, stamp = self.usage.get(client, (0., now))
+        return value * .5**((now - stamp)/self.half_life) + self.running[client] * self.mean_runtime
+    def __len__(self):
+        return sum(len(q) for c in self.queues.values() for q in c.values())
+    def _ordered_clients(self, job_class, now):
+        queues = self.queues[job_class]
+        return sorted(queues.keys(), key=lambda c:(self.get_usage(c, now), queues[c][0][1]))
+    def push(self, job):
+        """
+        Queues `job`
+
+        :return: the job's class, its client's current usage, and an estimate of how many jobs are ahead of it
+        :rtype: dict
+        """
+        now = time.time()
+        job_class = self.get_class(job)
+        client = self.get_client(job)
+        with self._lock:
+            queues = self.queues[job_class]
+            queues.setdefault(client, collections.deque()).append((job, now))
+            usage = self.get_usage(client, now)
+            ahead = sum(len(q) for c in self.job_classes[:self.job_classes.index(job_class)]
+                        for q in self.queues[c].values())
+            for c, q in queues.items():
+                if c == client:
+                    ahead += len(q) - 1
+                elif self.get_usage(c, now) <= usage:
+                    ahead += len(q)
+        return {"class":job_class, "usage":usage, "ahead":ahead}
+    def pop(self):
+        """
+        Pulls the next job to run (or `None`)
+        """
+        now = time.time()
+        with self._lock:
+            for job_class in self.job_classes:
+                queues = self.queues[job_class]
+                if len(queues) > 0:
+                    client = self._ordered_clients(job_class, now)[0]
+                    job, _ = queues[client].popleft()
+                    if len(queues[client]) == 0:
+                        del queues[client]
+                    self.running[client] += 1
+                    return job
+    def done(self, job, elapsed):
+        """
+        Charges `elapsed` seconds to the job's client
+        """
+        now = time.time()
+        client = self.get_client(job)
+        with self._lock:
+            self.running[client] -= 1
+            if self.running[client] <= 0:
+                del self.running[client]
+            value, stamp = self.usage.get(client, (0., now))
+            self.usage[client] = (value * .5**((now - stamp)/self.half_life) + elapsed, now)
+            self.mean_runtime = .9 * self.mean_runtime + .1 * elapsed
+
 class APIServer:
     """
     A minimal API driver that can parse jobs from JSON,
     then delegate to some sort of caller
     """
-    def __init__(self, socket, endpoints):
+    def __init__(self, socket, endpoints, max_workers=8, queue=None, spool=None, shm_ttl=10*60):
         """
         :param socket:
         :type socket: JobServer
         :param endpoints:
         :type endpoints:
+        :param max_workers: max number of jobs to run at once
+        :type max_workers: int
+        :param queue:
+        :type queue: FairShareQueue
+        :param spool: where to put outputs too big to send back directly
+        :type spool: ResultSpool
+        :param shm_ttl: how long clients get to claim a shared-memory block before we unlink it
+        :type shm_ttl: float
         """
         self.endpoints = {e.name:e for e in endpoints}
         self.socket = socket
+        self.max_workers = max_workers
+        self.spool = spool
+        self.shm_ttl = shm_ttl
+        self._shm_blocks = {}
+        self._shm_lock = threading.Lock()
+        # jobs that have had their final result sent
+        self._reported = set()
+        self._report_lock = threading.Lock()
+        if queue is None:
+            queue = FairShareQueue()
+        self.queue = queue
         self._active = False
     schema_keys = ['endpoint', 'arguments']
     def validate_job_schema(self, job):
@@ -277,12 +1830,12 @@ class APIServer:
         :type job: dict
         """
         return all(x in job for x in self.schema_keys)
-    def get_jobs(self):
+    def get_jobs(self, timeout=None):
         """
         Loads the job specifications
         """
         jobs = []
-        for job in self.socket.get_jobs():
+        for job in self.socket.get_jobs(timeout=timeout):
             if self.validate_job_schema(job):
                 if 'status' in job:
                     if job['status'] != 'ready':
@@ -312,24 +1865,84 @@ class APIServer:
         """
         print("CALLING: {}({})".format(endpoint.name, args))
         try:
-            res = endpoint(*args)
+            if self.spool is not None and getattr(endpoint, 'spoolable', False):
+                res = self.spool.run(endpoint, *args)
+            else:
+                res = endpoint(*args)
         except Exception as e:
             # err_msg = tb.format_exc()
             err_msg = str(e)
-            job_spec['status'] = 'error'
-            job_spec['output'] = err_msg
-            self.socket.write_result(job_spec)
+            self.report_result(job_spec, 'error', err_msg)
             print("ERROR:\n{}".format(err_msg))
         else:
-            job_spec['status'] = 'complete'
             if res is not None:
-                try:
-                    dump_test = json.dumps(res)
-                except:
-                    job_spec['output'] = str(res)
-                else:
-                    job_spec['output'] = res
-            self.socket.write_result(job_spec)
+                res = self.format_output(res, job_spec, spool=endpoint.spool_results)
+            self.report_result(job_spec, 'complete', res)
+    def report_result(self, job_spec, status, output=None):
+        """
+        Sends back the final result for a job, unless one already went out
+        (i.e. the server gave up on it and sent a timeout)
+
+        :return: whether the result was sent
+        :rtype: bool
+        """
+        with self._report_lock:
+            if id(job_spec) in self._reported:
+                return False
+            self._reported.add(id(job_spec))
+        job_spec['status'] = status
+        if output is not None:
+            job_spec['output'] = output
+        self.socket.write_result(job_spec)
+        return True
+    def format_output(self, res, job_spec, spool=True):
+        """
+        Makes the endpoint output something we can send back,
+        packing arrays as binary buffers if the client can take them
+        and spooling anything too big to send (if `spool`)
+        """
+        if is_spool_handle(res):
+            return res
+        modes = job_spec.get('accept_buffers', [])
+        if len(modes) > 0 and is_buffer_like(res):
+            try:
+                packed = pack_buffer(res, shared='shm' in modes)
+            except (TypeError, ValueError, BufferError):
+                # e.g. object arrays
+                pass
+            else:
+                header = packed['__buffer__']
+                if 'shm' in header:
+                    with self._shm_lock:
+                        self._shm_blocks[header['shm']] = time.time()
+                elif spool and self.spool is not None and len(header['data']) > self.spool.threshold:
+                    handle = self.spool.store(packed)
+                    # so the client knows to unpack it once it's pulled it down
+                    handle['buffer'] = True
+                    return handle
+                return packed
+        try:
+            dump_test = json.dumps(res)
+        except:
+            res = str(res)
+            dump_test = res
+        if spool and self.spool is not None and len(dump_test) > self.spool.threshold:
+            return self.spool.store(res, dump=dump_test)
+        return res
+    def sweep_shared_blocks(self):
+        """
+        Unlinks the shared-memory blocks that no client claimed within `shm_ttl` seconds
+        (e.g. because it died or timed out) so they don't sit in `/dev/shm` forever
+
+        :return: how many blocks were dropped
+        :rtype: int
+        """
+        now = time.time()
+        with self._shm_lock:
+            expired = [name for name, stamp in self._shm_blocks.items() if now - stamp > self.shm_ttl]
+            for name in expired:
+                del self._shm_blocks[name]
+        return sum(_release_shared_block(name) for name in expired)
 
     def handle_job(self, jspec):
         """
@@ -347,42 +1960,82 @@ class APIServer:
             )
             thread.start()
             return thread
+    def enqueue_job(self, jspec):
+        """
+        Puts a job in the fair-share queue and tells the client
+        where it stands
+        """
+        info = self.queue.push(jspec)
+        jspec['status'] = 'queued'
+        jspec['priority'] = info['class']
+        jspec['usage'] = info['usage']
+        jspec['position'] = info['ahead']
+        jspec['estimated_wait'] = info['ahead'] * self.queue.mean_runtime / self.max_workers
+        self.socket.write_result(jspec)
     kill_endpoint = 'stop_server'
     def server_loop(self, poll_time=.5, timeout=5): # how often to poll for jobs
         """
-        Starts a main-loop to server data
+        Starts a main-loop to server data.
+        New jobs go into the fair-share queue and are started in priority order
+        whenever one of the `max_workers` slots frees up.
+        Jobs that run past `timeout` get a timeout result but keep their slot
+        until their thread actually exits
         :return:
         :rtype:
         """
         self._active = True
+        running = []
         while self._active:
-            jobs = self.get_jobs()
-            active = []
-            for job in jobs:
+            # wait at most `poll_time` for new jobs so that freed slots
+            # get refilled from the queue even if no new jobs come in
+            jobs = self.get_jobs(timeout=poll_time)
+            for i, job in enumerate(jobs):
                 if job['endpoint'] == self.kill_endpoint:
                     job['status'] = 'complete'
                     self.socket.write_result(job)
                     self._active = False
+                    for rest in jobs[i+1:]:
+                        self.reject_job(rest)
                     break
-                else:
-                    thread = self.handle_job(job)
-                    if thread is not None:
-                        active.append([job, thread])
-                    else:
-                        job['status'] = 'complete'
-                        job['output'] = 'no endpoint {}; valid endpoints {}'.format(
-                            job['endpoint'],
-                            list(self.endpoints.keys()) + [self.kill_endpoint]
-                        )
-                        self.socket.write_result(job)
-            for job, thread in active:
-                thread.join(timeout=timeout)
-                if thread.is_alive():
-                    job['status'] = "timeout"
-                    job['output'] = ""
+                elif self.resolve_endpoint(job['endpoint']) is None:
+                    job['status'] = 'complete'
+                    job['output'] = 'no endpoint {}; valid endpoints {}'.format(
+                        job['endpoint'],
+                        list(self.endpoints.keys()) + [self.kill_endpoint]
+                    )
                     self.socket.write_result(job)
-                    print("ERROR: dangling thread never timed-out")
-            time.sleep(poll_time)
+                else:
+                    self.enqueue_job(job)
+            while self._active and len(running) < self.max_workers:
+                job = self.queue.pop()
+                if job is None:
+                    break
+                running.append([job, self.handle_job(job), time.time()])
+            still_running = []
+            for job, thread, start in running:
+                elapsed = time.time() - start
+                if not thread.is_alive():
+                    self.queue.done(job, elapsed)
+                    with self._report_lock:
+                        self._reported.discard(id(job))
+                else:
+                    if elapsed > timeout and self.report_result(job, "timeout", ""):
+                        print("ERROR: {} timed out but its thread is still running".format(job['endpoint']))
+                    still_running.append([job, thread, start])
+            running = still_running
+            self.sweep_shared_blocks()
+        # nobody's going to run what's left in the queue
+        job = self.queue.pop()
+        while job is not None:
+            self.reject_job(job)
+            job = self.queue.pop()
+    def reject_job(self, job, reason="server stopped before the job could run"):
+        """
+        Sends back an error for a job we're not going to run
+        """
+        job['status'] = 'error'
+        job['output'] = reason
+        self.socket.write_result(job)
 
 class JobClient(metaclass=abc.ABCMeta):
     """
@@ -398,8 +2051,20 @@ class JobClient(metaclass=abc.ABCMeta):
         :rtype:
         """
         base_name = job['endpoint']
-        arg_hash = hashlib.sha1(str(tuple(job['arguments'])).encode()).hexdigest()
+        key = tuple(job['arguments'])
+        if 'id' in job:
+            # lets the same job get submitted more than once
+            key = (job['id'], key)
+        arg_hash = hashlib.sha1(str(key).encode()).hexdigest()
         return "{}_{}".format(base_name, arg_hash)
+    # ways we can receive array outputs
+    buffer_modes = ['inline']
+    @property
+    def client_id(self):
+        """
+        Identifies this client to the server for fair-share scheduling
+        """
+        return "{}:{}".format(socket.gethostname(), os.getpid())
     @abc.abstractmethod
     def write_job(self, job):
         """
@@ -416,11 +2081,16 @@ class JobClient(metaclass=abc.ABCMeta):
         :rtype: str
         """
         job['name'] = self.get_job_name(job)
+        job.setdefault('client', self.client_id)
+        job.setdefault('accept_encoding', list(payload_codecs.keys()))
+        job.setdefault('accept_buffers', self.buffer_modes)
         self.write_job(job)
         return job
     @abc.abstractmethod
-    def get_results(self):
+    def get_results(self, timeout=None):
         """
+        :param timeout: how long to wait for something to come in (forever if `None`)
+        :type timeout: float
         :return:
         :rtype: Iterable[dict]
         """
@@ -433,6 +2103,7 @@ class FolderJobClient(JobClient):
         # cache of previous modification times
         # so that we can track multiple job results at once
         self.source = jobdir
+        os.makedirs(self.source, exist_ok=True)
         self._modtime_cache = {}
 
     def get_job_name(self, job):
@@ -477,29 +2148,40 @@ class FolderJobClient(JobClient):
                         jobs.append(f)
         return jobs
 
-    def get_results(self):
+    def get_results(self, timeout=None):
         """
         Gets all the results that have been written & which
-        are formatted properly
+        are formatted properly, waiting `timeout` and checking
+        again if there aren't any yet
         :return:
         :rtype:
         """
 
+        results = self._scan_results()
+        if len(results) == 0 and timeout is not None:
+            time.sleep(timeout)
+            results = self._scan_results()
+        return results
+
+    def _scan_results(self):
         mod_times = self._modtime_cache
         results = []
-        for f in os.listdir(self.source):
-            f = os.path.join(self.source, f)
-            if os.path.isfile(f) and (
-                    f not in mod_times
-                    or os.stat(f).st_mtime > mod_times[f]
-            ):
-                with open(f) as src:
-                    try:
-                        res = json.load(src)
-                    except:
-                        pass
-                    else:
-                        results.append(res)
+        # only our own job files can have our results in them
+        for f in list(mod_times.keys()):
+            try:
+                mtime = os.stat(f).st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime > mod_times[f]:
+                try:
+                    res = read_payload_file(f)
+                except:
+                    # probably caught it mid-write
+                    pass
+                else:
+                    mod_times[f] = mtime
+                    results.append(res)
+        return results
 
 class TCPJobClient(JobClient):
     """
@@ -521,6 +2203,12 @@ class TCPJobClient(JobClient):
         self._res_spec = res_spec
         self._connected = False
         self.chunk_size = 2**16
+        self._recv_buffer = ""
+        # filled in once the server tells us what it can decompress
+        self.server_encodings = []
+        if socket_type[0] == socket.AF_UNIX:
+            # we're on the same host as the server so we can share memory
+            self.buffer_modes = ['shm', 'inline']
 
     def bind(self, retries=5):
         """
@@ -551,24 +2239,26 @@ class TCPJobClient(JobClient):
         :return:
         :rtype: str
         """
-        sub = base64.b64encode(json.dumps(job).encode('ascii')).decode('ascii')
-        sub = '['+sub+']'
+        sub = wrap_payload(job, '[]', encodings=self.server_encodings)
         self.bind()
         send_bytes = sub.encode('ascii')
-        if len(send_bytes) > self.chunk_size:
-            raise ValueError("job too large to be sent with default chunk size {} (for {})".format(self.chunk_size, job))
         # print("PUTTING JOB IN SOCKET: (chunksize {})".format(self.chunk_size))
-        self.job_socket.send(send_bytes)
-    res_parser_regex = "\{[\w=+/]+\}"
-    def get_results(self):
+        self.job_socket.sendall(send_bytes)
+    res_parser_regex = "\{(?:\w+:)?[\w=+/]+\}"
+    def get_results(self, timeout=None):
         """
         Listens for results
         :return:
         :rtype:
         """
         self.bind()
+        if timeout is not None:
+            ready, _, _ = select.select([self.results_socket], [], [], timeout)
+            if len(ready) == 0:
+                return []
         # print("GETTING RESULTS OFF SOCKET: (chunksize {})".format(self.chunk_size))
         request_block = self.results_socket.recv(self.chunk_size).decode('ascii')
+        request_block, self._recv_buffer = split_frames(self._recv_buffer + request_block, "}")
 
         # jobs are sent as base-64 blobs wrapped in brackets
         if isinstance(self.res_parser_regex, str):
@@ -580,18 +2270,113 @@ class TCPJobClient(JobClient):
 
         results = []
         for req in requests:
-            req = req[1:-1]
             # print("GOT", req)
-            req = base64.b64decode(req)
             try:
-                res = json.loads(req)
+                res = unwrap_payload(req)
             except:
                 pass
             else:
+                if 'server_encoding' in res:
+                    self.server_encodings = [e for e in payload_codecs if e in res['server_encoding']]
                 results.append(res)
 
         return results
 
+class PilotWorker:
+    """
+    Worker that runs inside a pilot allocation, pulling `mcenv` tasks
+    from a `TaskFarm` on the driver and running them until it's been
+    idle for `idle_timeout` seconds, renewing its leases every `heartbeat` seconds
+    """
+    default_command = "/bin/bash /home/McEnv/CLI.sh"
+    def __init__(self, client, worker_id=None, command=None, prefix='farm', batch_size=1, idle_timeout=60,
+                 heartbeat=60, poll_time=.5, timeout=20):
+        """
+        :param client:
+        :type client: APIClient
+        :param command: command used to run tasks
+        :type command: str
+        :param heartbeat: how often to renew the leases on our tasks while they run
+        :type heartbeat: float
+        """
+        self.client = client
+        if worker_id is None:
+            worker_id = "{}-{}".format(socket.gethostname(), os.getpid())
+        self.worker_id = worker_id
+        if command is None:
+            command = self.default_command
+        self.command = shlex.split(command)
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.heartbeat = heartbeat
+        self.poll_time = poll_time
+        self.timeout = timeout
+    def call(self, endpoint, *args):
+        """
+        Runs a job on the driver and returns its output
+        """
+        job = self.client.socket.submit_job({"endpoint":self.prefix + "_" + endpoint, "arguments":list(args)})
+        res = self.client.read_result(job, polltime=self.poll_time, timeout=self.timeout)
+        if res['status'] != 'complete':
+            raise IOError("{} failed: {}".format(job['endpoint'], res.get('output', '')))
+        return res.get('output', None)
+    def run_task(self, task, task_ids=()):
+        """
+        Runs a single task through `mcenv`, renewing the leases on `task_ids` while it goes
+        """
+        runny = subprocess.Popen(
+            self.command + shlex.split(task),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        while True:
+            try:
+                stdout, stderr = runny.communicate(timeout=self.heartbeat)
+                break
+            except subprocess.TimeoutExpired:
+                try:
+                    self.call("renew", self.worker_id, *task_ids)
+                except IOError:
+                    # the driver requeues the task if we keep missing renewals
+                    pass
+        return {
+            "returncode":runny.returncode,
+            "stdout":stdout.decode().splitlines(),
+            "stderr":stderr.decode().splitlines()
+        }
+    def work_loop(self):
+        """
+        Pulls and runs tasks until there's nothing left to do
+
+        :return: number of tasks run
+        :rtype: int
+        """
+        ran = 0
+        last_task = time.time()
+        while time.time() - last_task < self.idle_timeout:
+            tasks = self.call("pull", self.worker_id, self.batch_size)
+            if tasks is None or len(tasks) == 0:
+                time.sleep(self.poll_time)
+                continue
+            held = [task_id for task_id, _ in tasks]
+            for task_id, task in tasks:
+                self.call("report", task_id, self.run_task(task, task_ids=held))
+                held.remove(task_id)
+                ran += 1
+            last_task = time.time()
+        return ran
+
+def run_pilot_worker(jobdir, worker_id, command=None, idle_timeout=60, heartbeat=60, poll_time=.5, timeout=20):
+    """
+    Entry point for the pilot worker processes
+    """
+    client = APIClient(FolderJobClient(jobdir))
+    worker = PilotWorker(client, worker_id=worker_id, command=command, idle_timeout=idle_timeout,
+                         heartbeat=heartbeat, poll_time=poll_time, timeout=timeout)
+    ran = worker.work_loop()
+    print("WORKER {}: ran {} tasks".format(worker_id, ran))
+
 class APIClient(code.InteractiveConsole):
     """
     Sets up a little API client that reads command-line input,
@@ -739,6 +2524,9 @@ class APIClient(code.InteractiveConsole):
                     else:
                         result['status'] = 'error'
                 status = result['status']
+                out = result.get('output', None)
+                if isinstance(out, dict) and '__buffer__' in out:
+                    result['output'] = unpack_buffer(out)
 
             if status in self.complete_statuses:
                 break
@@ -766,9 +2554,26 @@ class APIClient(code.InteractiveConsole):
             if 'output' not in result:
                 result['output'] = ""
             out = result['output']
+            if is_spool_handle(out) and out.get('buffer', False):
+                out = unpack_buffer(self.fetch_spool(out, poll_time=self._poll_time, timeout=self._timeout))
+            elif is_spool_handle(out):
+                # page through it rather than pulling it all in at once
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                try:
+                    for page in self.iter_spool(out, poll_time=self._poll_time, timeout=self._timeout):
+                        if isinstance(page, list):
+                            print("\n".join(page))
+                        else:
+                            print(decoder.decode(page), end="")
+                finally:
+                    self.call_driver('spool_release', out['__spool__'],
+                                     poll_time=self._poll_time, timeout=self._timeout)
+                return
             if isinstance(out, list):
-                out = "\n".join(out)
-            if len(out) > 0:
+                out = "\n".join(str(o) for o in out)
+            elif isinstance(out, memoryview):
+                out = out.tolist()
+            if not isinstance(out, str) or len(out) > 0:
                 print(out)
         elif result['status'] == 'error':
             if 'output' in result:
@@ -779,6 +2584,90 @@ class APIClient(code.InteractiveConsole):
             else:
                 print("ERROR ({}):".format(result['endpoint']), "no output")
 
+    def call_driver(self, endpoint, *args, poll_time=.5, timeout=20):
+        """
+        Submits a job and returns its output, raising an error if it failed
+
+        :param endpoint:
+        :type endpoint: str
+        :return:
+        :rtype:
+        """
+        job = self.socket.submit_job({"endpoint":endpoint, "arguments":list(args)})
+        res = self.read_result(job, polltime=poll_time, timeout=timeout)
+        if res['status'] != 'complete':
+            raise IOError("{} failed: {}".format(endpoint, res.get('output', '')))
+        out = res.get('output', None)
+        if is_spool_handle(out):
+            buffer = out.get('buffer', False)
+            out = self.fetch_spool(out, poll_time=poll_time, timeout=timeout)
+            if buffer:
+                out = unpack_buffer(out)
+        return out
+    def iter_spool(self, handle, page_lines=0, page_size=0, poll_time=.5, timeout=20):
+        """
+        Pages through a spooled output, yielding lists of lines for line spools
+        and raw `bytes` chunks otherwise
+
+        :param handle: the handle the driver sent back in place of the output
+        :type handle: dict
+        :return:
+        :rtype: Iterator[list | bytes]
+        """
+        spool_id = handle['__spool__']
+        if handle['format'] == 'lines':
+            start = 0
+            while True:
+                page = self.call_driver('spool_lines', spool_id, start, page_lines,
+                                        poll_time=poll_time, timeout=timeout)
+                if len(page['lines']) > 0:
+                    yield page['lines']
+                start = page['next']
+                if page['eof']:
+                    break
+        else:
+            offset = 0
+            while True:
+                page = self.call_driver('spool_read', spool_id, offset, page_size,
+                                        poll_time=poll_time, timeout=timeout)
+                yield page['data'].encode('utf-8', 'surrogateescape')
+                offset = page['offset']
+                if page['eof']:
+                    break
+    def fetch_spool(self, handle, release=True, poll_time=.5, timeout=20):
+        """
+        Pulls down a whole spooled output, giving back what the endpoint originally returned
+        """
+        try:
+            pages = list(self.iter_spool(handle, poll_time=poll_time, timeout=timeout))
+        finally:
+            if release:
+                self.call_driver('spool_release', handle['__spool__'], poll_time=poll_time, timeout=timeout)
+        if handle['format'] == 'lines':
+            return [l for page in pages for l in page]
+        data = b"".join(pages).decode()
+        return json.loads(data) if handle['format'] == 'json' else data
+    def watch_jobs(self, *job_ids, poll_time=5, timeout=20):
+        """
+        Yields state-change events for `job_ids` from the driver's `JobWatcher`
+        until they've all reached a final state
+
+        :param job_ids:
+        :type job_ids: str
+        :return:
+        :rtype: Iterator[dict]
+        """
+        sub = self.call_driver('watch_subscribe', *job_ids, timeout=timeout)
+        cursor = sub['cursor']
+        states = sub['states']
+        while any(s not in JobWatcher.final_states for s in states.values()):
+            time.sleep(poll_time)
+            res = self.call_driver('watch_events', cursor, *job_ids, timeout=timeout)
+            cursor = res['cursor']
+            for event in res['events']:
+                states[event['job']] = event['new']
+                yield event
+
     def runcode(self, job):
         return self.run_job(job, poll_time=self._poll_time, timeout=self._timeout)
     def run_job(self, job, poll_time=.5, timeout=20):
@@ -798,6 +2687,103 @@ class APIClient(code.InteractiveConsole):
         out = self.read_result(job, polltime=poll_time, timeout=timeout)
         self.handle_result(out)
 
+    def batch_loop(self, source, dest, window=16, ordered=True, poll_time=.5, timeout=20):
+        """
+        Non-interactive version of `client_loop` that reads one job per line
+        (anything `parse_job` takes) from `source` and keeps up to `window` jobs
+        in flight at once, writing the results to `dest` as JSON lines
+
+        :param source: file of jobs
+        :type source: Iterable[str]
+        :param dest: file for results
+        :type dest: IO
+        :param window: max number of outstanding jobs
+        :type window: int
+        :param ordered: whether to write results in input order rather than as they finish
+        :type ordered: bool
+        :return: the number of jobs that didn't complete
+        :rtype: int
+        """
+        final_statuses = self.complete_statuses | {'timeout'}
+        lines = enumerate(source)
+        seqs = itertools.count()
+        outstanding = {}
+        finished = {}
+        next_seq = [0]
+        failures = [0]
+        def finish(seq, record):
+            if record['status'] != 'complete':
+                failures[0] += 1
+            finished[seq] = record
+            if not ordered:
+                next_seq[0] = seq
+            while next_seq[0] in finished:
+                dest.write(json.dumps(finished.pop(next_seq[0])) + "\n")
+                next_seq[0] += 1
+            dest.flush()
+
+        exhausted = False
+        while not exhausted or len(outstanding) > 0:
+            while not exhausted and len(outstanding) < window:
+                try:
+                    line_no, line = next(lines)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if line.strip() == "" or line.strip().startswith("#"):
+                    continue
+                seq = next(seqs)
+                try:
+                    job = self.parse_job(line.strip())
+                    if job is None:
+                        raise ValueError("couldn't parse job")
+                except ValueError as e:
+                    finish(seq, {"line":line_no + 1, "status":"error", "output":str(e)})
+                    continue
+                job['id'] = "{}:{}".format(self.socket.client_id, seq)
+                job.setdefault('priority', 'batch')
+                # nobody's going to pick up a shared-memory block from a JSON file
+                job['accept_buffers'] = ['inline']
+                job = self.socket.submit_job(job)
+                outstanding[job['name']] = (seq, line_no, job, time.time())
+            if len(outstanding) == 0:
+                continue
+            # spool reads go through `read_result`, which parks anything else it sees in the buffer
+            results = list(self._res_buffer.values())
+            self._res_buffer.clear()
+            results.extend(self.socket.get_results(timeout=0 if results else poll_time))
+            for res in results:
+                name = res.get('name', None)
+                if name in outstanding and res.get('status', None) in final_statuses:
+                    seq, line_no, job, _ = outstanding.pop(name)
+                    status = res['status']
+                    out = res.get('output', None)
+                    if is_spool_handle(out):
+                        # pull the whole thing down so the driver can release it
+                        try:
+                            out = self.fetch_spool(out, poll_time=poll_time, timeout=timeout)
+                        except IOError as e:
+                            status, out = "error", "couldn't read spooled output: {}".format(e)
+                    finish(seq, {
+                        "line":line_no + 1,
+                        "endpoint":res['endpoint'],
+                        "arguments":res['arguments'],
+                        "status":status,
+                        "output":out
+                    })
+            now = time.time()
+            for name, (seq, line_no, job, start) in list(outstanding.items()):
+                if now - start > timeout:
+                    del outstanding[name]
+                    finish(seq, {
+                        "line":line_no + 1,
+                        "endpoint":job['endpoint'],
+                        "arguments":job['arguments'],
+                        "status":"error",
+                        "output":"timeout"
+                    })
+        return failures[0]
+
     default_prompt = "<api-client> $ "
     def client_loop(self, poll_time=.5, timeout=20):
         """
@@ -848,6 +2834,11 @@ if __name__ == "__main__":
                         default='',
                         dest='archivedir'
                         )
+    parser.add_argument('--archiveage',
+                        type=float,
+                        default=60*60,
+                        dest='archiveage'
+                        )
     parser.add_argument('--polltime',
                         type=float,
                         default=1,
@@ -868,6 +2859,130 @@ if __name__ == "__main__":
                         default="socket",
                         dest='jobmode'
                         )
+    parser.add_argument('--watchtime',
+                        type=float,
+                        default=30,
+                        dest='watchtime'
+                        )
+    parser.add_argument('--schedrate',
+                        type=float,
+                        default=5,
+                        dest='schedrate'
+                        )
+    parser.add_argument('--acctdb',
+                        type=str,
+                        default='',
+                        dest='acctdb'
+                        )
+    parser.add_argument('--gitmirrors',
+                        type=str,
+                        default='',
+                        dest='gitmirrors'
+                        )
+    parser.add_argument('--gitage',
+                        type=float,
+                        default=0,
+                        dest='gitage'
+                        )
+    parser.add_argument('--spooldir',
+                        type=str,
+                        default='',
+                        dest='spooldir'
+                        )
+    parser.add_argument('--spoolsize',
+                        type=float,
+                        default=32,
+                        dest='spoolsize'
+                        )
+    parser.add_argument('--maxjobs',
+                        type=int,
+                        default=8,
+                        dest='maxjobs'
+                        )
+    parser.add_argument('--shmttl',
+                        type=float,
+                        default=10*60,
+                        dest='shmttl'
+                        )
+    parser.add_argument('--executor',
+                        type=str,
+                        default='thread',
+                        dest='executor'
+                        )
+    parser.add_argument('--poolsize',
+                        type=int,
+                        default=4,
+                        dest='poolsize'
+                        )
+    parser.add_argument('--preload',
+                        type=str,
+                        default='',
+                        dest='preload'
+                        )
+    parser.add_argument('--recycle',
+                        type=int,
+                        default=100,
+                        dest='recycle'
+                        )
+    parser.add_argument('--workermem',
+                        type=float,
+                        default=0,
+                        dest='workermem'
+                        )
+    parser.add_argument('--jobmem',
+                        type=float,
+                        default=0,
+                        dest='jobmem'
+                        )
+    parser.add_argument('--jobtime',
+                        type=float,
+                        default=0,
+                        dest='jobtime'
+                        )
+    parser.add_argument('--input',
+                        type=str,
+                        default='-',
+                        dest='input'
+                        )
+    parser.add_argument('--output',
+                        type=str,
+                        default='-',
+                        dest='output'
+                        )
+    parser.add_argument('--window',
+                        type=int,
+                        default=16,
+                        dest='window'
+                        )
+    parser.add_argument('--unordered',
+                        action='store_true',
+                        dest='unordered'
+                        )
+    parser.add_argument('--workers',
+                        type=int,
+                        default=0,
+                        dest='workers'
+                        )
+    parser.add_argument('--taskcmd',
+                        type=str,
+                        default=PilotWorker.default_command,
+                        dest='taskcmd'
+                        )
+    parser.add_argument('--idletime',
+                        type=float,
+                        default=60,
+                        dest='idletime'
+                        )
+    parser.add_argument('--heartbeat',
+                        type=float,
+                        default=60,
+                        dest='heartbeat'
+                        )
+    parser.add_argument('--farmlease',
+                        type=float,
+                        default=600,
+                        dest='farmlease'
+                        )
     boolz = lambda s: False if len(s) == 0 else bool(eval(s))
     parser.add_argument('--exec',
                         type=boolz,
@@ -879,7 +2994,7 @@ if __name__ == "__main__":
     archivedir = opts.archivedir
     if archivedir == "":
         archivedir = os.path.join(jobdir, 'archive')
-    if opts.mode == "client":
+    if opts.mode == "client" or opts.mode == "batch":
         if opts.jobmode=='socket':
             jobs, results = os.path.join(jobdir, '.jobs'), os.path.join(jobdir, '.results')
             job_client = TCPJobClient(jobs, results)
@@ -889,20 +3004,101 @@ if __name__ == "__main__":
             job_client,
             banner="="*40 + "STARTING NODE CLIENT" + "="*40
         )
-        SLURMClient.client_loop(poll_time=opts.polltime, timeout=opts.timeout)
+        if opts.mode == "client":
+            SLURMClient.client_loop(poll_time=opts.polltime, timeout=opts.timeout)
+        else:
+            source = sys.stdin if opts.input == "-" else open(opts.input)
+            dest = sys.stdout if opts.output == "-" else open(opts.output, 'w')
+            try:
+                failures = SLURMClient.batch_loop(source, dest,
+                                                  window=opts.window,
+                                                  ordered=not opts.unordered,
+                                                  poll_time=opts.polltime,
+                                                  timeout=opts.timeout
+                                                  )
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+                if dest is not sys.stdout:
+                    dest.close()
+            sys.exit(1 if failures > 0 else 0)
+    elif opts.mode == "pilot":
+        # workers on different nodes can only share the folder transport
+        if opts.jobmode == 'socket':
+            raise ValueError("pilot workers need '--jobmode folder' on storage shared with the driver")
+        nworkers = opts.workers
+        if nworkers <= 0:
+            nworkers = len(os.sched_getaffinity(0))
+        print("="*40, "STARTING {} PILOT WORKERS".format(nworkers), "="*40)
+        workers = [
+            multiprocessing.Process(
+                target=run_pilot_worker,
+                args=(jobdir, "{}-{}-{}".format(socket.gethostname(), os.getpid(), i)),
+                kwargs=dict(command=opts.taskcmd, idle_timeout=opts.idletime, heartbeat=opts.heartbeat,
+                            poll_time=opts.polltime, timeout=opts.timeout)
+            )
+            for i in range(nworkers)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
     else:
-        endpoints = [
+        # every scheduler command gets its own limiter
+        limiter = lambda: RateLimiter(rate=opts.schedrate)
+        squeue = SubprocessEndPoint('squeue', rate_limiter=limiter())
+        sacct = SubprocessEndPoint('sacct', rate_limiter=limiter())
+        watcher = JobWatcher(squeue=squeue, sacct=sacct, interval=opts.watchtime)
+        acctdb = opts.acctdb
+        if acctdb == "":
+            acctdb = os.path.join(jobdir, 'accounting.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(acctdb)), exist_ok=True)
+        accounting = AccountingCache(acctdb, sacct=sacct)
+        mirror_dir = opts.gitmirrors
+        if mirror_dir == "":
+            mirror_dir = os.path.join(jobdir, 'git-mirrors')
+        git = SubprocessEndPoint('git')
+        mirrors = GitMirror(mirror_dir, git=git, max_age=opts.gitage)
+        spool_dir = opts.spooldir
+        if spool_dir == "":
+            spool_dir = os.path.join(jobdir, 'spool')
+        # spool size comes in as KB
+        spool = ResultSpool(spool_dir, threshold=int(opts.spoolsize * 2**10))
+        sbatch = SbatchEndPoint('sbatch', watcher=watcher, rate_limiter=limiter())
+        python_endpoints = [
                 PythonEndPoint("pwd", 'os.getcwd'),
-                PythonEndPoint("ls", 'os.listdir'),
-                PythonEndPoint("cd", 'os.chdir', escape=True),
-                SubprocessEndPoint('sbatch'),
-                SubprocessEndPoint('squeue'),
-                SubprocessEndPoint('sinfo'),
-                SubprocessEndPoint('scancel'),
-                SubprocessEndPoint('git')
+                PythonEndPoint("ls", 'os.listdir')
             ]
         if opts.allow_exec:
-            endpoints.append(ExecEndPoint("exec"))
+            python_endpoints.append(ExecEndPoint("exec"))
+        pool = None
+        if opts.executor == 'process':
+            # memory limits come in as MB
+            pool = WorkerPool(
+                size=opts.poolsize,
+                preload=[m for m in opts.preload.split(",") if m != ""],
+                max_jobs=opts.recycle,
+                max_memory=int(opts.workermem * 2**20) if opts.workermem > 0 else None,
+                job_memory=int(opts.jobmem * 2**20) if opts.jobmem > 0 else None,
+                job_timeout=opts.jobtime if opts.jobtime > 0 else None
+            )
+            python_endpoints = [PooledEndPoint(e, pool) for e in python_endpoints]
+        endpoints = [
+                *python_endpoints,
+                # has to change the driver's own cwd so it can't go in the pool
+                PythonEndPoint("cd", 'os.chdir', escape=True),
+                sbatch,
+                WorkflowEndPoint('workflow', sbatch=sbatch),
+                squeue,
+                SubprocessEndPoint('sinfo', rate_limiter=limiter()),
+                SubprocessEndPoint('scancel', rate_limiter=limiter()),
+                git,
+                *mirrors.endpoints(),
+                *spool.endpoints(),
+                *TaskFarm(lease=opts.farmlease).endpoints(),
+                *watcher.endpoints(),
+                *accounting.endpoints()
+            ]
 
         if opts.jobmode=='socket':
             jobs, results = os.path.join(jobdir, '.jobs'), os.path.join(jobdir, '.results')
@@ -916,11 +3112,19 @@ if __name__ == "__main__":
                 pass
             job_server = TCPJobServer(jobs, results)
         else:
-            job_server = FolderJobServer(jobdir, archivedir)
+            job_server = FolderJobServer(jobdir, archivedir, archive_age=opts.archiveage)
         SLURMDriver = APIServer(
             job_server,
-            endpoints
+            endpoints,
+            max_workers=opts.maxjobs,
+            spool=spool,
+            shm_ttl=opts.shmttl
         )
 
         print("="*40, "STARTING NODE DRIVER", "="*40)
-        SLURMDriver.server_loop(poll_time=opts.polltime, timeout=opts.timeout)
\ No newline at end of file
+        watcher.start()
+        try:
+            SLURMDriver.server_loop(poll_time=opts.polltime, timeout=opts.timeout)
+        finally:
+            if pool is not None:
+                pool.shutdown()
\ No newline at end of file